@@ -84,6 +84,7 @@ class NerfLink():
             Option(OptionCode.IF_DESCRIPTION, "Nordic BLE Sniffer Firmware")
             ])
         self._pktsec = p
+        self._pcap = PcapngStreamWriter('test.pcapng', p)
 
     def update_screen(self, loop, data):
         pl = self.pktlist
@@ -91,10 +92,8 @@ class NerfLink():
         for pkt in self._sniffer.pbuf:
             pl.append(pkt)
             self.cnt = self.cnt + 1
-            self._pktsec.add_packet(EnhancedPacketBlock(pkt.data))
+            self._pcap.write_packet(pkt)
 
-    #    with open('test.pcapng', 'wb') as f:
-    #        f.write(self._pktsec.as_bytearray)
         loop.set_alarm_in(1/30, self.update_screen)
 
     def twisted_callback(self):
@@ -103,7 +102,10 @@ class NerfLink():
 
     def run(self):
         self.loop.set_alarm_in(1/60, self.update_screen)
-        self.loop.run()
+        try:
+            self.loop.run()
+        finally:
+            self._pcap.close()
 
     def unhandled_input(self, key):
         if key in ('q', 'Q'):
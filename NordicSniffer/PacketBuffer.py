@@ -1,51 +1,231 @@
-from .packets import SlipPacket, UartPacket
+from collections import deque
+from enum import IntEnum
+import struct
+from .filter import PacketFilter
+from .packets import SlipDecoder, UartPacket, UartPacketIds
+from .timestamps import PacketClock
+
+_EVENT_PACKET = int(UartPacketIds.EVENT_PACKET)
+
+class OverflowPolicy(IntEnum):
+    DROP_OLDEST = 0
+    DROP_NEWEST = 1
+    PAUSE = 2
 
 class PacketBuffer():
-    in_buf = bytearray()
-    out_buf = []
-    buffer_limit = 0
+    """FIFO of decoded UartPackets, fed with raw UART data.
+
+    Once high_water packets are waiting to be read the overflow policy
+    decides what happens: DROP_OLDEST discards from the head of the
+    queue, DROP_NEWEST discards the incoming packets and PAUSE asks the
+    attached transport to stop reading until the queue drains down to
+    low_water.  Everything discarded is counted.  A high_water of 0
+    turns the queue off altogether, for when all of the packets are
+    consumed by sinks.
+
+    Sinks subscribed to the buffer (anything with a write_packet method)
+    see every decoded packet as it arrives, before the overflow policy
+    is applied to the queue.  Sinks that also have write_packets get each
+    chunk's packets in one call.
+
+    Packets are timestamped (in µs) by clock, a PacketClock unless one
+    is passed in.
+
+    Gaps in the firmware's 16 bit packet counter are counted in
+    packets_lost; that covers packets lost anywhere between the sniffer
+    and here, including frames the decoder had to throw away.  A jump
+    backwards (more than half the counter range) is taken as the
+    firmware restarting rather than loss and counted in seq_resets.
 
-    def __init__(self, buffer_limit=65536):
+    EVENT_PACKETs that don't get through packet_filter (a PacketFilter,
+    or an expression for one) are dropped before a UartPacket is made
+    for them; they're still timestamped and sequence checked, so the
+    filter changes neither the timing nor the loss counts."""
+
+    def __init__(self, buffer_limit=65536, high_water=4096, low_water=None,
+                 policy=OverflowPolicy.DROP_OLDEST, transport=None, clock=None,
+                 packet_filter=None):
         self.buffer_limit = buffer_limit
+        self.high_water = high_water
+        self.low_water = high_water // 2 if low_water is None else low_water
+        self.policy = OverflowPolicy(policy)
+        self._transport = transport
+        self._paused = False
+        self._decoder = SlipDecoder(max_frame_len=buffer_limit)
+        self._clock = PacketClock() if clock is None else clock
+        self._out_buf = deque()
+        self._sinks = []
+        self.bytes_in = 0
+        self.packets_in = 0
+        self.packets_dropped = 0
+        self.bad_packets = 0
+        self.packets_lost = 0
+        self.seq_resets = 0
+        self._seq_id = None
+        self.packet_filter = packet_filter
+        # decoded packets, indexed by UART packet ID
+        self.frames_by_id = [0] * 256
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if len(self.out_buf) == 0:
+        pkt = self.get()
+        if pkt is None:
             raise StopIteration
-        pkt = self.out_buf.pop(0)
         return pkt
 
-    def add(self, rcvd_data):
-        pbuf = self.in_buf
-        pbuf.extend(bytearray(rcvd_data))
-        headroom = self.buffer_limit - len(pbuf)
-        if headroom < 0:
-            print("in_buf exceeds limit by {:d} bytes, trimming".format(-headroom))
-            del pbuf[:-headroom]
-        pkt_cnt = self._process_in_buf()
+    def __len__(self):
+        return len(self._out_buf)
 
+    def add(self, rcvd_data):
+        pkt_cnt = self._process_in_buf(rcvd_data)
         return pkt_cnt
 
     def size(self):
-        return out_buf.size()
+        return len(self._out_buf)
 
     def get(self):
         packet = None
-        if len(self.out_buf) > 0:
-            packet = self.out_buf.pop()
+        if len(self._out_buf) > 0:
+            packet = self._out_buf.popleft()
+            if self._paused and len(self._out_buf) <= self.low_water:
+                self._resume()
         return packet
 
-    def _process_in_buf(self):
-        """Uses the SlipPacket class to extract packets from the
-        in_buffer.  These will then be converted into UartPackets
-        and stored in the out_buffer."""
-        packets = SlipPacket.find(self.in_buf)
+    def attach(self, transport):
+        """transport used for flow control under the PAUSE policy; it needs
+        pauseProducing()/resumeProducing(), like Twisted's SerialPort."""
+        self._transport = transport
+
+    def subscribe(self, sink):
+        self._sinks.append(sink)
+
+    def unsubscribe(self, sink):
+        self._sinks.remove(sink)
+
+    @property
+    def decoder(self):
+        return self._decoder
+
+    @property
+    def seq_id(self):
+        """packet counter of the latest packet"""
+        return self._seq_id
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def packet_filter(self):
+        return self._filter
+
+    @packet_filter.setter
+    def packet_filter(self, packet_filter):
+        if isinstance(packet_filter, str):
+            packet_filter = PacketFilter(packet_filter)
+        self._filter = packet_filter
+
+    @property
+    def paused(self):
+        return self._paused
+
+    @property
+    def bytes_dropped(self):
+        """raw bytes thrown away by the decoder (noise between frames,
+        truncated or oversized frames)"""
+        return self._decoder.discarded
+
+    def _pause(self):
+        if self._transport is not None:
+            self._transport.pauseProducing()
+            self._paused = True
+
+    def _resume(self):
+        self._paused = False
+        self._transport.resumeProducing()
+
+    def _enqueue(self, uart_pkts):
+        if self.high_water == 0:
+            return
+        out_buf = self._out_buf
+        headroom = self.high_water - len(out_buf)
+        overage = len(uart_pkts) - headroom
+        if overage <= 0:
+            out_buf.extend(uart_pkts)
+            return
+
+        policy = self.policy
+        if policy == OverflowPolicy.PAUSE and self._transport is not None:
+            # Whatever was already read still gets queued; pausing keeps
+            # the next chunk in the sniffer/OS instead.
+            out_buf.extend(uart_pkts)
+            if not self._paused:
+                self._pause()
+        elif policy == OverflowPolicy.DROP_NEWEST or policy == OverflowPolicy.PAUSE:
+            out_buf.extend(uart_pkts[:max(headroom, 0)])
+            self.packets_dropped += overage
+        else:
+            out_buf.extend(uart_pkts)
+            dropped = len(out_buf) - self.high_water
+            for _ in range(dropped):
+                out_buf.popleft()
+            self.packets_dropped += dropped
+
+    def _process_in_buf(self, rcvd_data):
+        """Feeds newly received data through the SLIP decoder.  Any
+        frames it completes are converted into UartPackets and stored
+        in the out_buffer; a partial frame stays in the decoder until
+        the rest of it arrives."""
+        self.bytes_in += len(rcvd_data)
+        frames = self._decoder.feed(rcvd_data)
         uart_pkts = []
-        for pkt in packets:
-            uart_pkt = UartPacket(pkt.data)
+        by_id = self.frames_by_id
+        seq = self._seq_id
+        lost = 0
+        stamps = self._clock.stamp_chunk(frames) if frames else ()
+        packet_filter = self._filter
+        match = None if packet_filter is None else packet_filter.match
+        rejected = 0
+        for frame, stamp in zip(frames, stamps):
+            if (match is not None and len(frame) > 5 and frame[5] == _EVENT_PACKET
+                    and not match(frame)):
+                uart_pkt = None
+            else:
+                try:
+                    uart_pkt = UartPacket(frame, timestamp=stamp)
+                except (ValueError, IndexError, struct.error):
+                    self.bad_packets += 1
+                    continue
+            by_id[frame[5]] += 1
+            pc = frame[3] | frame[4] << 8
+            if seq is not None:
+                gap = (pc - seq - 1) & 0xFFFF
+                if gap >= 0x8000:
+                    self.seq_resets += 1
+                else:
+                    lost += gap
+            seq = pc
+            if uart_pkt is None:
+                rejected += 1
+                continue
             uart_pkts.append(uart_pkt)
 
-        self.out_buf.extend(uart_pkts)
+        self._seq_id = seq
+        if match is not None:
+            packet_filter.rejected += rejected
+            packet_filter.matched += len(uart_pkts)
+        if lost:
+            self.packets_lost += lost
+        self.packets_in += len(uart_pkts)
+        if uart_pkts:
+            for sink in self._sinks:
+                write_packets = getattr(sink, 'write_packets', None)
+                if write_packets is not None:
+                    write_packets(uart_pkts)
+                else:
+                    for uart_pkt in uart_pkts:
+                        sink.write_packet(uart_pkt)
+        self._enqueue(uart_pkts)
         return len(uart_pkts)
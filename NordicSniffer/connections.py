@@ -0,0 +1,282 @@
+from array import array
+from bisect import bisect_left
+from enum import Enum
+from struct import Struct
+from twisted.logger import Logger
+from .packets import BleLinkLayerPacket, SnifferPacket, UartPacket, UartPacketIds
+
+log = Logger(namespace="Connections")
+
+ADV_ACCESS_ADDRESS = 0x8E89BED6
+CONNECT_REQ = 0x05
+
+# Where things sit in an EVENT_PACKET frame with the default header
+# lengths
+_LL_OFFSET = UartPacket.HLEN_DEFAULT + SnifferPacket.HEADER_STRUCT.size
+_LL_HEADER = BleLinkLayerPacket.HEADER_STRUCT
+_EVENT_PACKET = int(UartPacketIds.EVENT_PACKET)
+
+# InitA, AdvA, then the LLData: access address, CRC init, window size,
+# window offset, interval, latency, timeout, channel map, hop/SCA
+_CONNECT_REQ = Struct("<6s6sI3sBHHHH5sB")
+
+# LL_TERMINATE_IND: control PDU (LLID 3) with opcode 0x02
+_LLID_CONTROL = 0x03
+_LL_TERMINATE_IND = 0x02
+
+class ConnectionState(Enum):
+    REQUESTED = 'requested'     # CONNECT_REQ seen
+    FOLLOWING = 'following'     # firmware says it's on the connection
+    CLOSED = 'closed'
+
+def link_layer_offset(data, offset=0):
+    """Where the link layer packet starts in the EVENT_PACKET frame at
+    data[offset:]"""
+    if (data[offset + UartPacket.HLEN_OFFSET] == UartPacket.HLEN_DEFAULT and
+            data[offset + UartPacket.HLEN_DEFAULT] == SnifferPacket.HEADER_STRUCT.size):
+        return offset + _LL_OFFSET
+    hlen = data[offset + UartPacket.HLEN_OFFSET]
+    return offset + hlen + data[offset + hlen]
+
+def frame_end(data, offset=0):
+    """Where the frame at data[offset:] ends, going by its own header;
+    data may carry more after it"""
+    end = (offset + data[offset + UartPacket.HLEN_OFFSET] +
+           data[offset + UartPacket.PLEN_OFFSET])
+    return min(end, len(data))
+
+def _address(raw):
+    """BD_ADDR as it's usually written (the air has it backwards)"""
+    return ':'.join('{:02X}'.format(b) for b in reversed(raw))
+
+class Connection:
+    """What's known about one connection, from its CONNECT_REQ and what
+    the sniffer has said since.  interval, latency and timeout are in
+    the spec's units (1.25ms, events, 10ms); see interval_us and
+    timeout_us."""
+
+    def __init__(self, aa, crc_init, init_addr, adv_addr, win_size, win_offset,
+                 interval, latency, timeout, channel_map, hop, sca,
+                 position=None, timestamp=None):
+        self.aa = aa
+        self.crc_init = crc_init
+        self.init_addr = init_addr
+        self.adv_addr = adv_addr
+        self.win_size = win_size
+        self.win_offset = win_offset
+        self.interval = interval
+        self.latency = latency
+        self.timeout = timeout
+        self.channel_map = channel_map
+        self.hop = hop
+        self.sca = sca
+        self.state = ConnectionState.REQUESTED
+        self.connect_position = position
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.packets = 0
+
+    def __repr__(self):
+        return ("<Connection; aa=[{:08x}], crc_init=[{:06x}], ".format(self.aa, self.crc_init) +
+                "{} -> {}, ".format(self.init_addr, self.adv_addr) +
+                "interval={}us, state={}, ".format(self.interval_us, self.state.value) +
+                "packets={}>".format(self.packets))
+
+    @classmethod
+    def from_connect_req(cls, payload, position=None, timestamp=None):
+        """Parses a CONNECT_REQ PDU payload; ValueError if it's short"""
+        if len(payload) < _CONNECT_REQ.size:
+            raise ValueError("CONNECT_REQ is {} bytes, not {}".format(len(payload),
+                                                                     _CONNECT_REQ.size))
+        (init_addr, adv_addr, aa, crc_init, win_size, win_offset, interval,
+         latency, timeout, chm, hop_sca) = _CONNECT_REQ.unpack_from(payload)
+        return cls(aa, int.from_bytes(crc_init, byteorder='little'),
+                   _address(init_addr), _address(adv_addr), win_size, win_offset,
+                   interval, latency, timeout,
+                   int.from_bytes(chm, byteorder='little') & ((1 << 37) - 1),
+                   hop_sca & 0x1F, hop_sca >> 5, position, timestamp)
+
+    @property
+    def channels(self):
+        """data channels in use, from the channel map"""
+        return [ch for ch in range(37) if self.channel_map & (1 << ch)]
+
+    @property
+    def interval_us(self):
+        return self.interval * 1250
+
+    @property
+    def timeout_us(self):
+        return self.timeout * 10000
+
+    @property
+    def open(self):
+        return self.state is not ConnectionState.CLOSED
+
+
+class ConnectionTracker:
+    """Follows the connections in a packet stream.
+
+    Subscribed as a sink (NordicSniffer.add_sink()), it picks up each
+    CONNECT_REQ on the advertising channels, keeps a Connection for it
+    and updates its state from the sniffer's EVENT_CONNECT /
+    EVENT_FOLLOW / EVENT_DISCONNECT and from LL_TERMINATE_IND.
+
+    Every packet on a data channel access address has its position
+    recorded against that address (positions count the packets the
+    tracker has been handed, so they're capture indexes when it sees the
+    same packets as the writer from the start), which makes pulling one
+    conversation out of a capture a lookup of just its packets:
+
+        for idx in tracker.positions(conn.aa):
+            pkt = reader[idx]
+
+    Advertising packets aren't indexed unless index_advertising is set,
+    as that's usually most of the capture.  crc_inits maps access
+    address to CRC init, for check_crcs()."""
+
+    def __init__(self, index_advertising=False):
+        self._index_advertising = index_advertising
+        self._index = {}
+        self._connections = []
+        self._by_aa = {}
+        self.crc_inits = {}
+        self._following = None
+        self._position = 0
+        self.connect_reqs = 0
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __iter__(self):
+        return iter(self._connections)
+
+    def __contains__(self, aa):
+        return aa in self._by_aa
+
+    def __getitem__(self, aa):
+        """the latest connection on access address aa"""
+        return self._by_aa[aa]
+
+    @classmethod
+    def from_capture(cls, reader, **kwargs):
+        """Builds the index for a capture (a PcapngReader) in one pass."""
+        tracker = cls(**kwargs)
+        tracker.write_packets(reader.packets())
+        return tracker
+
+    @property
+    def connections(self):
+        return self._connections
+
+    @property
+    def following(self):
+        """the connection the sniffer is on, if any"""
+        return self._following
+
+    @property
+    def position(self):
+        """number of packets seen"""
+        return self._position
+
+    def open_connections(self):
+        return [conn for conn in self._connections if conn.open]
+
+    def access_addresses(self):
+        return list(self._index)
+
+    def positions(self, aa):
+        """positions of the packets on access address aa, in order"""
+        return self._index.get(aa, array('Q'))
+
+    def conversation(self, conn):
+        """positions of the CONNECT_REQ and every packet on conn's access
+        address since"""
+        positions = self.positions(conn.aa)
+        start = conn.connect_position
+        if start is None:
+            return list(positions)
+        return [start] + list(positions[bisect_left(positions, start):])
+
+    # Sink interface
+    def write_packet(self, packet):
+        self.write_packets((packet,))
+
+    def write_packets(self, packets):
+        index = self._index
+        index_adv = self._index_advertising
+        by_aa = self._by_aa
+        unpack_ll = _LL_HEADER.unpack_from
+        position = self._position
+        for pkt in packets:
+            data = pkt._data
+            offset = pkt._offset
+            if data[offset + UartPacket.ID_OFFSET] != _EVENT_PACKET:
+                self._event(pkt, position)
+                position += 1
+                continue
+            ll = link_layer_offset(data, offset)
+            end = frame_end(data, offset)
+            if end < ll + BleLinkLayerPacket.PAYLOAD:
+                position += 1
+                continue
+            aa, pdu_header, length = unpack_ll(data, ll)
+            if aa == ADV_ACCESS_ADDRESS:
+                if pdu_header & 0x0F == CONNECT_REQ:
+                    self._connect_req(pkt, ll, min(length, end - ll - BleLinkLayerPacket.PAYLOAD),
+                                      position)
+                if not index_adv:
+                    position += 1
+                    continue
+            else:
+                conn = by_aa.get(aa)
+                if conn is not None:
+                    conn.packets += 1
+                    conn.last_seen = pkt.timestamp
+                    if (pdu_header & 0x03 == _LLID_CONTROL and length and
+                            ll + BleLinkLayerPacket.PAYLOAD < end and
+                            data[ll + BleLinkLayerPacket.PAYLOAD] == _LL_TERMINATE_IND and
+                            data[offset + data[offset + UartPacket.HLEN_OFFSET] +
+                                 SnifferPacket.FLAGS] & 0x01):
+                        self._close(conn)
+            positions = index.get(aa)
+            if positions is None:
+                positions = index[aa] = array('Q')
+            positions.append(position)
+            position += 1
+        self._position = position
+
+    def _connect_req(self, pkt, ll, length, position):
+        start = ll + BleLinkLayerPacket.PAYLOAD
+        try:
+            conn = Connection.from_connect_req(pkt._data[start:start+length],
+                                               position, pkt.timestamp)
+        except ValueError as e:
+            log.debug("bad CONNECT_REQ at {pos}: {err}", pos=position, err=e)
+            return
+        self.connect_reqs += 1
+        old = self._by_aa.get(conn.aa)
+        if old is not None and old.open:
+            self._close(old)
+        self._connections.append(conn)
+        self._by_aa[conn.aa] = conn
+        self.crc_inits[conn.aa] = conn.crc_init
+        log.debug("{conn}", conn=conn)
+
+    def _event(self, pkt, position):
+        pkt_id = pkt.id
+        if pkt_id in (UartPacketIds.EVENT_CONNECT, UartPacketIds.EVENT_FOLLOW):
+            # Sent once the firmware has jumped on the CONNECT_REQ it just
+            # passed up
+            conn = self._connections[-1] if self._connections else None
+            if conn is not None and conn.open:
+                conn.state = ConnectionState.FOLLOWING
+                self._following = conn
+        elif pkt_id == UartPacketIds.EVENT_DISCONNECT:
+            if self._following is not None:
+                self._close(self._following)
+
+    def _close(self, conn):
+        conn.state = ConnectionState.CLOSED
+        if self._following is conn:
+            self._following = None
@@ -0,0 +1,136 @@
+import os
+from collections import OrderedDict
+from twisted.logger import Logger
+from .connections import ADV_ACCESS_ADDRESS, frame_end, link_layer_offset
+from .packets import BleLinkLayerPacket, UartPacket, UartPacketIds
+from .pcapng import PcapngStreamWriter
+
+log = Logger(namespace="Demux")
+
+_EVENT_PACKET = int(UartPacketIds.EVENT_PACKET)
+_AA = BleLinkLayerPacket.HEADER_STRUCT
+
+class ConnectionDemux:
+    """Sink that splits a capture by access address as it's captured.
+
+    Advertising channel packets go to one combined file (adv_name) and
+    each connection's packets to a file of its own (name_format, given
+    the access address as aa), all in directory and all with section's
+    header.  At most max_open connection files are kept open; the least
+    recently written is closed to make room, and reopened for appending
+    if its connection turns up again, so thousands of short connections
+    don't run out of file descriptors.  Frames that aren't EVENT_PACKETs
+    aren't written anywhere (they're counted in skipped)."""
+
+    def __init__(self, directory, section, max_open=64,
+                 name_format='conn-{aa:08x}.pcapng', adv_name='advertising.pcapng'):
+        if max_open < 1:
+            raise ValueError("max_open must be at least 1")
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._section = section
+        self._max_open = max_open
+        self._name_format = name_format
+        self._writers = OrderedDict()
+        self._paths = {}
+        self._counts = {}
+        self._adv = PcapngStreamWriter(os.path.join(directory, adv_name), section)
+        self._closed = False
+        self.skipped = 0
+        self.reopened = 0
+        self.evicted = 0
+
+    def __len__(self):
+        """number of connection files"""
+        return len(self._paths)
+
+    @property
+    def advertising(self):
+        """the advertising channel writer"""
+        return self._adv
+
+    @property
+    def open_files(self):
+        return len(self._writers)
+
+    @property
+    def paths(self):
+        """{access address: connection file}"""
+        return self._paths
+
+    @property
+    def packets_written(self):
+        return self._adv.packets_written + sum(self._counts.values())
+
+    def packet_count(self, aa):
+        return self._counts.get(aa, 0)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        while self._writers:
+            _, writer = self._writers.popitem(last=False)
+            writer.close()
+        self._adv.close()
+
+    def flush(self):
+        for writer in self._writers.values():
+            writer.flush()
+        self._adv.flush()
+
+    # Sink interface
+    def write_packet(self, packet):
+        self.write_packets((packet,))
+
+    def write_packets(self, packets):
+        if self._closed:
+            return
+        adv = []
+        by_aa = {}
+        unpack_aa = _AA.unpack_from
+        for pkt in packets:
+            data = pkt._data
+            offset = pkt._offset
+            if data[offset + UartPacket.ID_OFFSET] != _EVENT_PACKET:
+                self.skipped += 1
+                continue
+            ll = link_layer_offset(data, offset)
+            if frame_end(data, offset) < ll + BleLinkLayerPacket.PAYLOAD:
+                self.skipped += 1
+                continue
+            aa = unpack_aa(data, ll)[0]
+            if aa == ADV_ACCESS_ADDRESS:
+                adv.append(pkt)
+            else:
+                group = by_aa.get(aa)
+                if group is None:
+                    group = by_aa[aa] = []
+                group.append(pkt)
+        if adv:
+            self._adv.write_packets(adv)
+        for aa, group in by_aa.items():
+            self._writer(aa).write_packets(group)
+            self._counts[aa] = self._counts.get(aa, 0) + len(group)
+
+    def _writer(self, aa):
+        writers = self._writers
+        writer = writers.get(aa)
+        if writer is not None:
+            writers.move_to_end(aa)
+            return writer
+        if len(writers) >= self._max_open:
+            _, oldest = writers.popitem(last=False)
+            oldest.close()
+            self.evicted += 1
+        path = self._paths.get(aa)
+        if path is None:
+            path = self._paths[aa] = os.path.join(self._directory,
+                                                  self._name_format.format(aa=aa))
+            writer = PcapngStreamWriter(path, self._section)
+            log.debug("new connection file {path}", path=path)
+        else:
+            writer = PcapngStreamWriter(path, self._section, append=True)
+            self.reopened += 1
+        writers[aa] = writer
+        return writer
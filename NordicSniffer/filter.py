@@ -0,0 +1,250 @@
+import re
+import struct
+from .packets import UartPacketIds
+
+ADV_ACCESS_ADDRESS = 0x8E89BED6
+_EVENT_PACKET = int(UartPacketIds.EVENT_PACKET)
+
+class FilterError(ValueError):
+    """A filter expression that doesn't parse; pos is where in it"""
+
+    def __init__(self, message, expression, pos):
+        super().__init__("{} at {}: {!r}".format(message, pos, expression[pos:] or expression))
+        self.expression = expression
+        self.pos = pos
+
+# What each field compiles to.  f is the frame, h where the sniffer
+# header starts and l where the link layer packet starts.
+FIELDS = {
+    'channel': 'f[h+2]',
+    'rssi': '(-f[h+3])',
+    'flags': 'f[h+1]',
+    'crc_ok': '(f[h+1]&1!=0)',
+    'crc_error': '(f[h+1]&1==0)',
+    'from_master': '(f[h+1]&2!=0)',
+    'encrypted': '(f[h+1]&4!=0)',
+    'mic_ok': '(f[h+1]&8!=0)',
+    'ec': '(f[h+4]|f[h+5]<<8)',
+    'tdiff': '_u32(f,h+6)[0]',
+    'aa': '_u32(f,l)[0]',
+    'adv': '(_u32(f,l)[0]=={})'.format(ADV_ACCESS_ADDRESS),
+    'pdu_type': '(f[l+4]&15)',
+    'llid': '(f[l+4]&3)',
+    'length': 'f[l+5]',
+}
+
+# Fields whose literals are always read as hex
+HEX_FIELDS = ('aa',)
+
+_TOKEN = re.compile(r'\s*(?:(?P<num>-?(?:0[xX][0-9a-fA-F]+|[0-9][0-9a-fA-F]*))'
+                    r'|(?P<name>[A-Za-z_][A-Za-z0-9_]*)'
+                    r'|(?P<op>==|!=|<=|>=|&&|\|\||[<>!(),]))')
+_KEYWORDS = {'and': '&&', 'or': '||', 'not': '!', 'in': 'in'}
+_COMPARISONS = ('==', '!=', '<', '<=', '>', '>=')
+
+def tokenize(expression):
+    """(kind, text, position) for each token; kind is 'num', 'name' or 'op'"""
+    tokens = []
+    pos = 0
+    end = len(expression.rstrip())
+    while pos < end:
+        m = _TOKEN.match(expression, pos)
+        if m is None or m.end() == pos:
+            pos = len(expression) - len(expression[pos:].lstrip())
+            raise FilterError("unexpected character", expression, pos)
+        kind = m.lastgroup
+        text = m.group(kind)
+        start = m.start(kind)
+        if kind == 'name' and text.lower() in _KEYWORDS:
+            kind, text = 'op', _KEYWORDS[text.lower()]
+        tokens.append((kind, text, start))
+        pos = m.end()
+    return tokens
+
+class _Parser:
+    """Recursive descent over the tokens, producing Python source:
+
+        expr       := and_expr ('or' and_expr)*
+        and_expr   := not_expr ('and' not_expr)*
+        not_expr   := 'not' not_expr | '(' expr ')' | test
+        test       := operand [cmp operand | ['not'] 'in' '(' literal, ... ')']
+    """
+
+    def __init__(self, expression):
+        self._expression = expression
+        self._tokens = tokenize(expression)
+        self._pos = 0
+        self.fields = set()
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None, len(self._expression))
+
+    def _next(self):
+        token = self._peek()
+        self._pos += 1
+        return token
+
+    def _error(self, message, token=None):
+        token = self._peek() if token is None else token
+        return FilterError(message, self._expression, token[2])
+
+    def _expect(self, text):
+        token = self._next()
+        if token[0] != 'op' or token[1] != text:
+            raise self._error("expected '{}'".format(text), token)
+
+    def parse(self):
+        if not self._tokens:
+            raise self._error("empty filter")
+        source = self._or()
+        if self._pos < len(self._tokens):
+            raise self._error("unexpected '{}'".format(self._peek()[1]))
+        return source
+
+    def _or(self):
+        terms = [self._and()]
+        while self._peek()[:2] == ('op', '||'):
+            self._next()
+            terms.append(self._and())
+        return terms[0] if len(terms) == 1 else '({})'.format(' or '.join(terms))
+
+    def _and(self):
+        terms = [self._not()]
+        while self._peek()[:2] == ('op', '&&'):
+            self._next()
+            terms.append(self._not())
+        return terms[0] if len(terms) == 1 else '({})'.format(' and '.join(terms))
+
+    def _not(self):
+        kind, text, _ = self._peek()
+        if kind == 'op' and text == '!':
+            self._next()
+            return '(not {})'.format(self._not())
+        if kind == 'op' and text == '(':
+            self._next()
+            source = self._or()
+            self._expect(')')
+            return source
+        return self._test()
+
+    def _operand(self):
+        token = self._next()
+        kind, text, _ = token
+        if kind == 'name' and text in FIELDS:
+            self.fields.add(text)
+            return ('field', text)
+        if kind == 'name' and re.fullmatch('(0[xX])?[0-9a-fA-F]+', text) is None:
+            raise self._error("unknown field '{}'".format(text), token)
+        if kind in ('num', 'name'):
+            return ('literal', token)
+        raise self._error("expected a field or a number", token)
+
+    def _literal(self, token, hex_only):
+        _, text, _ = token
+        try:
+            if hex_only:
+                value = int(text[2:] if text.lower().startswith('0x') else text, 16)
+            else:
+                value = int(text, 0)
+        except ValueError:
+            raise self._error("unknown field or bad number '{}'".format(text), token) from None
+        return str(value)
+
+    def _source(self, operand, hex_only):
+        if operand[0] == 'field':
+            return FIELDS[operand[1]]
+        return self._literal(operand[1], hex_only)
+
+    def _test(self):
+        left = self._operand()
+        kind, text, _ = self._peek()
+        negate = False
+        if kind == 'op' and text == '!' and self._tokens[self._pos+1:self._pos+2] and \
+                self._tokens[self._pos+1][1] == 'in':
+            self._next()
+            kind, text, _ = self._peek()
+            negate = True
+        if kind == 'op' and text == 'in':
+            self._next()
+            if left[0] != 'field':
+                raise self._error("'in' needs a field on the left")
+            hex_only = left[1] in HEX_FIELDS
+            self._expect('(')
+            values = [self._literal(self._next(), hex_only)]
+            while self._peek()[:2] == ('op', ','):
+                self._next()
+                values.append(self._literal(self._next(), hex_only))
+            self._expect(')')
+            return '({} {}in ({},))'.format(FIELDS[left[1]], 'not ' if negate else '',
+                                           ','.join(values))
+        if kind == 'op' and text in _COMPARISONS:
+            self._next()
+            right = self._operand()
+            hex_only = any(side[0] == 'field' and side[1] in HEX_FIELDS
+                           for side in (left, right))
+            return '({}{}{})'.format(self._source(left, hex_only), text,
+                                     self._source(right, hex_only))
+        if left[0] != 'field':
+            raise self._error("a number on its own isn't a test", left[1])
+        return FIELDS[left[1]]
+
+_TEMPLATE = """\
+def _match(f):
+    try:
+        h = f[0]
+        l = h + f[h]
+        return bool({})
+    except (IndexError, struct.error):
+        return True
+"""
+
+class PacketFilter:
+    """Capture filter, compiled once from an expression like
+
+        channel in (37, 38) and rssi > -70 and aa == 8e89bed6 and not crc_error
+
+    into a function that reads the fields straight out of a decoded
+    EVENT_PACKET frame, before any packet objects get built.  Fields are
+    listed in FIELDS; aa literals are always hex.  and/or/not can also
+    be written &&, || and !.
+
+    Frames that aren't EVENT_PACKETs always pass (as do truncated ones,
+    which get thrown out later anyway).  Whatever runs the filter counts
+    the frames it let through in matched and the ones it threw out in
+    rejected; see PacketBuffer."""
+
+    def __init__(self, expression):
+        parser = _Parser(expression)
+        self._source = parser.parse()
+        self._fields = frozenset(parser.fields)
+        self._expression = expression
+        namespace = {'struct': struct, '_u32': struct.Struct('<I').unpack_from}
+        exec(compile(_TEMPLATE.format(self._source), '<filter>', 'exec'), namespace)
+        self.match = namespace['_match']
+        self.matched = 0
+        self.rejected = 0
+
+    def __repr__(self):
+        return "PacketFilter({!r})".format(self._expression)
+
+    def __call__(self, frame):
+        """True if the raw frame gets through"""
+        if len(frame) <= 5 or frame[5] != _EVENT_PACKET:
+            return True
+        return self.match(frame)
+
+    @property
+    def expression(self):
+        return self._expression
+
+    @property
+    def fields(self):
+        """fields the expression looks at"""
+        return self._fields
+
+    @property
+    def source(self):
+        """the Python expression it compiled to"""
+        return self._source
@@ -0,0 +1,82 @@
+from collections import namedtuple
+from time import time_ns
+from twisted.internet import reactor, task
+from twisted.logger import Logger
+
+log = Logger(namespace="PacketLoss")
+
+# Counts for one reporting window
+LossWindow = namedtuple('LossWindow', ['start', 'end', 'received', 'dropped', 'discarded'])
+
+class LossReporter:
+    """Records packet loss in the capture as Interface Statistics Blocks.
+
+    Every interval seconds (and on stop()) an ISB is written for iface_id
+    with the totals since the reporter started: isb_ifrecv is what the
+    sniffer sent (packets decoded plus packets missing from its packet
+    counter), isb_ifdrop the missing ones and isb_osdrop the frames the
+    decoder had to throw away on the way (already part of ifdrop, which
+    is where they show up as gaps).  Packets a capture filter threw out
+    still count as received, and what it let through goes in
+    isb_filteraccept.  The section's dropcount is kept up to date, and
+    the latest window's own counts are in last_window."""
+
+    def __init__(self, writer, pbuf, iface_id=0, interval=10.0, clock=reactor):
+        self._writer = writer
+        self._pbuf = pbuf
+        self._iface_id = iface_id
+        self._loop = task.LoopingCall(self.report)
+        self._loop.clock = clock
+        self._interval = interval
+        self._start = self._now()
+        self._last = (self._start, 0, 0, 0)
+        self.last_window = None
+
+    def _now(self):
+        now = getattr(self._pbuf.clock, 'now', None)
+        return now() if now is not None else time_ns() // 1000
+
+    @property
+    def received(self):
+        packet_filter = self._pbuf.packet_filter
+        rejected = 0 if packet_filter is None else packet_filter.rejected
+        return self._pbuf.packets_in + self._pbuf.packets_lost + rejected
+
+    @property
+    def dropped(self):
+        return self._pbuf.packets_lost
+
+    @property
+    def discarded(self):
+        return self._pbuf.decoder.dropped + self._pbuf.bad_packets
+
+    def start(self):
+        self._loop.start(self._interval, now=False)
+        return self
+
+    def stop(self):
+        """Writes the final ISB; call before closing the writer."""
+        if self._loop.running:
+            self._loop.stop()
+        if not self._writer.closed:
+            self.report()
+
+    def report(self):
+        now = self._now()
+        received, dropped, discarded = self.received, self.dropped, self.discarded
+        packet_filter = self._pbuf.packet_filter
+        self._writer.write_isb(self._iface_id, timestamp=now, starttime=self._start,
+                               endtime=now, ifrecv=received, ifdrop=dropped,
+                               osdrop=discarded,
+                               filteraccept=None if packet_filter is None else packet_filter.matched)
+        start, last_received, last_dropped, last_discarded = self._last
+        window = LossWindow(start, now, received - last_received,
+                            dropped - last_dropped, discarded - last_discarded)
+        self._writer.section.dropcount += window.dropped
+        self._last = (now, received, dropped, discarded)
+        self.last_window = window
+        if window.dropped:
+            log.info("interface {iface}: lost {dropped} of {received} packets",
+                     iface=self._iface_id, dropped=window.dropped,
+                     received=window.received)
+        return window
@@ -0,0 +1,260 @@
+import os
+from twisted.internet import reactor, task
+from twisted.logger import Logger
+from .packets import UartPacketIds
+
+log = Logger(namespace="Metrics")
+
+class Metric:
+    """A named metric with one value per set of labels.
+
+    Values are either kept here (inc()/set()) or read from a function
+    when the metric is collected (set_function()), which is how the
+    pipeline's own counters get exposed without any extra work on the
+    hot path.  set_mapping() takes a function returning {label value:
+    number} for a whole family at once."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._functions = {}
+        self._mappings = {}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def set_function(self, func, **labels):
+        self._functions[self._key(labels)] = func
+        return self
+
+    def set_mapping(self, func, label, **labels):
+        self._mappings[(label, self._key(labels))] = func
+        return self
+
+    def remove(self, **labels):
+        key = self._key(labels)
+        self._values.pop(key, None)
+        self._functions.pop(key, None)
+        for mkey in [k for k in self._mappings if k[1] == key]:
+            del self._mappings[mkey]
+
+    def value(self, **labels):
+        key = self._key(labels)
+        func = self._functions.get(key)
+        if func is not None:
+            return func()
+        return self._values.get(key, 0)
+
+    def samples(self):
+        """Yields (labels, value) for every series"""
+        for key, value in self._values.items():
+            yield dict(key), value
+        for key, func in self._functions.items():
+            yield dict(key), func()
+        for (label, key), func in self._mappings.items():
+            for name, value in func().items():
+                labels = dict(key)
+                labels[label] = name
+                yield labels, value
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class MetricsRegistry:
+    """Holds the pipeline's metrics.  Read them from Python with
+    value() / snapshot(), or as Prometheus text with as_prometheus()."""
+
+    def __init__(self, prefix='sharktoothle'):
+        self.prefix = prefix
+        self._metrics = {}
+
+    def __contains__(self, name):
+        return self._full_name(name) in self._metrics
+
+    def __iter__(self):
+        return iter(self._metrics.values())
+
+    def _full_name(self, name):
+        return '{}_{}'.format(self.prefix, name) if self.prefix else name
+
+    def _get(self, cls, name, help):
+        full_name = self._full_name(name)
+        metric = self._metrics.get(full_name)
+        if metric is None:
+            metric = self._metrics[full_name] = cls(full_name, help)
+        elif not isinstance(metric, cls):
+            raise ValueError("{} is already a {}".format(full_name, metric.kind))
+        return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def get(self, name):
+        return self._metrics[self._full_name(name)]
+
+    def value(self, name, **labels):
+        return self.get(name).value(**labels)
+
+    def snapshot(self):
+        """{series name: value}, series named like name{label="value"}"""
+        values = {}
+        for metric in self._metrics.values():
+            for labels, value in metric.samples():
+                values[_series(metric.name, labels)] = value
+        return values
+
+    def as_prometheus(self):
+        lines = []
+        for metric in self._metrics.values():
+            if metric.help:
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for labels, value in metric.samples():
+                lines.append('{} {}'.format(_series(metric.name, labels), value))
+        lines.append('')
+        return '\n'.join(lines)
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())))
+
+
+class PrometheusFile:
+    """Writes the registry out in Prometheus text format every interval
+    seconds (e.g. for node_exporter's textfile collector).  Each write
+    goes to a temporary file that's renamed over path, so a scrape never
+    sees half a file."""
+
+    def __init__(self, registry, path, interval=10.0, clock=reactor):
+        self._registry = registry
+        self._path = path
+        self._interval = interval
+        self._loop = task.LoopingCall(self.write)
+        self._loop.clock = clock
+        self.writes = 0
+
+    def start(self):
+        self._loop.start(self._interval, now=True)
+        return self
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+        self.write()
+
+    def write(self):
+        tmp = '{}.tmp'.format(self._path)
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self._registry.as_prometheus())
+            os.replace(tmp, self._path)
+        except OSError as e:
+            log.warn("couldn't write {path}: {err}", path=self._path, err=e)
+            return
+        self.writes += 1
+
+
+# Hooking up the pipeline.  Everything is read from the counters the
+# stages already keep, when the registry is collected.
+def _id_name(pkt_id):
+    try:
+        return UartPacketIds(pkt_id).name
+    except ValueError:
+        return '0x{:02X}'.format(pkt_id)
+
+def track_packet_buffer(registry, pbuf, **labels):
+    decoder = pbuf.decoder
+    registry.counter('serial_bytes_total', "raw bytes received from the sniffer"
+                     ).set_function(lambda: pbuf.bytes_in, **labels)
+    registry.counter('slip_frames_total', "SLIP frames decoded"
+                     ).set_function(lambda: decoder.frames, **labels)
+    registry.counter('slip_escapes_total', "SLIP escape sequences"
+                     ).set_function(lambda: decoder.escapes, **labels)
+    registry.counter('slip_errors_total', "malformed SLIP frames"
+                     ).set_function(lambda: decoder.errors, **labels)
+    registry.counter('slip_dropped_frames_total', "frames the SLIP decoder threw away"
+                     ).set_function(lambda: decoder.dropped, **labels)
+    registry.counter('trimmed_bytes_total', "bytes thrown away between or instead of frames"
+                     ).set_function(lambda: decoder.discarded, **labels)
+    registry.counter('decode_errors_total', "frames that didn't decode as UART packets"
+                     ).set_function(lambda: pbuf.bad_packets, **labels)
+    registry.counter('packets_total', "UART packets decoded"
+                     ).set_function(lambda: pbuf.packets_in, **labels)
+    registry.counter('packets_by_id_total', "UART packets decoded, by packet ID"
+                     ).set_mapping(lambda: {_id_name(i): n for i, n in
+                                            enumerate(pbuf.frames_by_id) if n},
+                                   'id', **labels)
+    registry.counter('packets_lost_total', "gaps in the sniffer's packet counter"
+                     ).set_function(lambda: pbuf.packets_lost, **labels)
+    registry.counter('seq_resets_total', "packet counter restarts"
+                     ).set_function(lambda: pbuf.seq_resets, **labels)
+    registry.counter('queue_dropped_total', "packets dropped by the overflow policy"
+                     ).set_function(lambda: pbuf.packets_dropped, **labels)
+    registry.gauge('queue_depth', "packets waiting in the PacketBuffer"
+                   ).set_function(lambda: len(pbuf), **labels)
+    registry.gauge('paused', "1 while reading from the sniffer is paused"
+                   ).set_function(lambda: int(pbuf.paused), **labels)
+    registry.counter('filter_matched_total', "frames let through by the capture filter"
+                     ).set_function(lambda: getattr(pbuf.packet_filter, 'matched', 0), **labels)
+    registry.counter('filter_rejected_total', "EVENT_PACKETs dropped by the capture filter"
+                     ).set_function(lambda: getattr(pbuf.packet_filter, 'rejected', 0), **labels)
+    clock = pbuf.clock
+    if hasattr(clock, 'resyncs'):
+        registry.counter('clock_resyncs_total', "timestamp drift corrections"
+                         ).set_function(lambda: clock.resyncs, **labels)
+
+def track_sniffer(registry, sniffer, **labels):
+    labels.setdefault('port', sniffer.port)
+    track_packet_buffer(registry, sniffer.pbuf, **labels)
+
+def track_writer(registry, writer, **labels):
+    """a PcapngStreamWriter (or anything with the same counters)"""
+    registry.counter('pcapng_bytes_total', "bytes written to pcapng output"
+                     ).set_function(lambda: writer.bytes_written, **labels)
+    registry.counter('pcapng_packets_total', "packets written to pcapng output"
+                     ).set_function(lambda: writer.packets_written, **labels)
+
+def track_pipe(registry, pipe, **labels):
+    labels.setdefault('consumer', 'pipe')
+    track_writer(registry, pipe, **labels)
+    registry.counter('consumer_dropped_packets_total', "packets a consumer couldn't keep up with"
+                     ).set_function(lambda: pipe.packets_dropped, **labels)
+    registry.gauge('consumer_lag_bytes', "bytes waiting for a consumer"
+                   ).set_function(lambda: pipe.pending_bytes, **labels)
+
+def track_consumer(registry, consumer, name, **labels):
+    """anything that queues packets for someone else to read (a
+    PacketStream, say): its len() is the lag"""
+    labels['consumer'] = name
+    registry.gauge('consumer_lag_packets', "packets waiting for a consumer"
+                   ).set_function(lambda: len(consumer), **labels)
+    if hasattr(consumer, 'dropped'):
+        registry.counter('consumer_dropped_packets_total', "packets a consumer couldn't keep up with"
+                         ).set_function(lambda: consumer.dropped, **labels)
@@ -0,0 +1,119 @@
+import heapq
+import os
+from twisted.internet.serialport import SerialPort
+from twisted.logger import Logger
+from .PacketBuffer import PacketBuffer
+from .pcapng import (LINKTYPE_BLUETOOTH_LE_LL, Option, OptionCode, PcapngStreamWriter,
+                     Section, SHB_OPTION_HARDWARE, SHB_OPTION_USERAPPL)
+from .sniffer import NordicSniffer
+
+log = Logger(namespace="MultiSniffer")
+
+class MergeWindow:
+    """Puts packets from several interfaces back into timestamp order.
+
+    Packets are held in a heap and released to sink.write_packet(pkt,
+    iface_id=...) once they're more than window older than the newest
+    packet seen, or when more than max_packets are waiting, so memory
+    stays bounded however long the capture runs.  A packet that turns up
+    after something newer was already released goes straight out and is
+    counted in late."""
+
+    def __init__(self, sink, window=100000, max_packets=65536):
+        self._sink = sink
+        self.window = window
+        self.max_packets = max_packets
+        self._heap = []
+        self._seq = 0
+        self._newest = None
+        self._released = None
+        self.late = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, iface_id, packet):
+        ts = packet.timestamp
+        if self._released is not None and ts < self._released:
+            self.late += 1
+            self._sink.write_packet(packet, iface_id=iface_id)
+            return
+        # seq keeps equal timestamps in arrival order and stops the heap
+        # from ever comparing packets
+        heapq.heappush(self._heap, (ts, self._seq, iface_id, packet))
+        self._seq += 1
+        if self._newest is None or ts > self._newest:
+            self._newest = ts
+        self._release(self._newest - self.window)
+
+    def flush(self):
+        """Releases everything still held."""
+        self._release(None)
+
+    def _release(self, horizon):
+        heap = self._heap
+        write = self._sink.write_packet
+        while heap and (horizon is None or heap[0][0] <= horizon or
+                        len(heap) > self.max_packets):
+            ts, _, iface_id, packet = heapq.heappop(heap)
+            self._released = ts
+            write(packet, iface_id=iface_id)
+
+class _InterfaceSink:
+    """Tags one sniffer's packets with its interface number."""
+
+    def __init__(self, merge, iface_id):
+        self._merge = merge
+        self._iface_id = iface_id
+
+    def write_packet(self, packet):
+        self._merge.push(self._iface_id, packet)
+
+class MultiSnifferCapture:
+    """Captures from several sniffers at once (e.g. one per advertising
+    channel) into a single pcapng.  Each port gets its own IDB, and the
+    packets are merged into timestamp order through a MergeWindow before
+    being written with the matching interface ID.  baud and baud_rates
+    are passed on to each NordicSniffer."""
+
+    def __init__(self, ports, output, window=100000, max_packets=65536,
+                 transport=SerialPort, baud=460800, baud_rates=None):
+        section = Section(LINKTYPE_BLUETOOTH_LE_LL)
+        section.shb.options.add([
+            Option(SHB_OPTION_HARDWARE, "Nordic NRF52 Bluetooth LE Sniffer"),
+            Option(SHB_OPTION_USERAPPL, "SharkToothLE")
+            ])
+        for iface_id, port in enumerate(ports):
+            idb = section.idb if iface_id == 0 else section.add_interface(LINKTYPE_BLUETOOTH_LE_LL)
+            idb.options.add([
+                Option(OptionCode.IF_NAME, os.path.basename(port)),
+                Option(OptionCode.IF_DESCRIPTION, "Nordic BLE Sniffer Firmware")
+                ])
+        self._section = section
+        self._writer = PcapngStreamWriter(output, section)
+        self._merge = MergeWindow(self._writer, window=window, max_packets=max_packets)
+        self._sniffers = []
+        for iface_id, port in enumerate(ports):
+            sniffer = NordicSniffer(port=port, baud=baud, transport=transport,
+                                    pbuf=PacketBuffer(high_water=0), baud_rates=baud_rates)
+            sniffer.add_sink(_InterfaceSink(self._merge, iface_id))
+            self._sniffers.append(sniffer)
+        log.info("capturing from {ports}", ports=", ".join(ports))
+
+    @property
+    def sniffers(self):
+        return self._sniffers
+
+    @property
+    def merge(self):
+        return self._merge
+
+    @property
+    def writer(self):
+        return self._writer
+
+    def close(self):
+        """Writes out whatever the merge is still holding and closes the
+        capture."""
+        self._merge.flush()
+        self._writer.close()
@@ -0,0 +1,249 @@
+import multiprocessing
+import struct
+import time
+from collections import Counter
+from multiprocessing import shared_memory
+from twisted.internet import reactor
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.logger import Logger
+from zope.interface import implementer
+from .packets import SlipDecoder, UartPacket
+from .timestamps import PacketClock
+from .sniffer import NordicSniffer
+
+log = Logger(namespace="Offload")
+
+class SharedRing:
+    """Single producer, single consumer byte ring in shared memory.
+
+    The first 16 bytes hold the total number of bytes ever written and
+    ever read; each side only updates its own counter, after moving the
+    data, so no lock is needed.  Records are a length and an arrival
+    timestamp (ns) followed by the chunk, and are all-or-nothing: a
+    chunk that doesn't fit is dropped and counted rather than blocking
+    the producer."""
+
+    CONTROL = struct.Struct("<QQ")
+    RECORD = struct.Struct("<IQ")
+
+    def __init__(self, capacity=1 << 22, name=None):
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True,
+                                                   size=self.CONTROL.size + capacity)
+            self.CONTROL.pack_into(self._shm.buf, 0, 0, 0)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self.capacity = len(self._shm.buf) - self.CONTROL.size
+        self._data = self._shm.buf[self.CONTROL.size:self.CONTROL.size + self.capacity]
+        self.dropped_chunks = 0
+        self.dropped_bytes = 0
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def _counters(self):
+        return self.CONTROL.unpack_from(self._shm.buf, 0)
+
+    @property
+    def used(self):
+        written, read = self._counters()
+        return written - read
+
+    def put(self, chunk, timestamp=0):
+        """Producer side: appends a chunk, returns False if it was
+        dropped for lack of space."""
+        written, read = self._counters()
+        size = self.RECORD.size + len(chunk)
+        if size > self.capacity - (written - read):
+            self.dropped_chunks += 1
+            self.dropped_bytes += len(chunk)
+            return False
+        pos = written % self.capacity
+        self._copy_in(pos, self.RECORD.pack(len(chunk), timestamp))
+        self._copy_in((pos + self.RECORD.size) % self.capacity, chunk)
+        struct.pack_into("<Q", self._shm.buf, 0, written + size)
+        return True
+
+    def get(self):
+        """Consumer side: returns every (timestamp, chunk) waiting."""
+        written, read = self._counters()
+        records = []
+        while read < written:
+            pos = read % self.capacity
+            length, timestamp = self.RECORD.unpack(self._copy_out(pos, self.RECORD.size))
+            start = (pos + self.RECORD.size) % self.capacity
+            records.append((timestamp, self._copy_out(start, length)))
+            read += self.RECORD.size + length
+        struct.pack_into("<Q", self._shm.buf, 8, read)
+        return records
+
+    def _copy_in(self, pos, data):
+        first = min(len(data), self.capacity - pos)
+        self._data[pos:pos+first] = data[:first]
+        if first < len(data):
+            self._data[:len(data)-first] = data[first:]
+
+    def _copy_out(self, pos, length):
+        first = min(length, self.capacity - pos)
+        out = bytes(self._data[pos:pos+first])
+        if first < length:
+            out += bytes(self._data[:length-first])
+        return out
+
+    def close(self):
+        self._data.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _decode_worker(ring_name, output, section, conn, stop, report_interval, recent):
+    """Worker process: drains the ring, decodes, writes the capture and
+    reports back a summary every report_interval seconds."""
+    from .pcapng import PcapngStreamWriter
+    ring = SharedRing(name=ring_name)
+    decoder = SlipDecoder()
+    clock = PacketClock()
+    writer = PcapngStreamWriter(output, section) if output is not None else None
+    ids = Counter()
+    latest = []
+    totals = {'packets': 0, 'bytes': 0, 'bad_packets': 0}
+    next_report = time.monotonic() + report_interval
+    idle = 0.0005
+
+    def report(final=False):
+        conn.send({'packets': totals['packets'], 'bytes': totals['bytes'],
+                   'bad_packets': totals['bad_packets'],
+                   'decode_errors': decoder.errors, 'ids': dict(ids),
+                   'recent': latest[-recent:], 'final': final})
+        del latest[:]
+
+    try:
+        while True:
+            stopping = stop.is_set()
+            records = ring.get()
+            for timestamp, chunk in records:
+                totals['bytes'] += len(chunk)
+                pkts = []
+                frames = decoder.feed(chunk)
+                stamps = clock.stamp_chunk(frames, timestamp // 1000) if frames else ()
+                for frame, stamp in zip(frames, stamps):
+                    try:
+                        pkt = UartPacket(frame, timestamp=stamp)
+                    except (ValueError, IndexError, struct.error):
+                        totals['bad_packets'] += 1
+                        continue
+                    pkts.append(pkt)
+                    ids[pkt.id.name] += 1
+                    latest.append((pkt.timestamp, pkt.pc, int(pkt.id), pkt.plen))
+                del latest[:-recent]
+                totals['packets'] += len(pkts)
+                if writer is not None and pkts:
+                    writer.write_packets(pkts)
+
+            now = time.monotonic()
+            if now >= next_report:
+                report()
+                next_report = now + report_interval
+            if stopping and not records:
+                break
+            if not records:
+                time.sleep(idle)
+    finally:
+        if writer is not None:
+            writer.close()
+        report(final=True)
+        conn.close()
+        ring.close()
+
+
+@implementer(IReadDescriptor)
+class OffloadPipeline:
+    """Moves decoding and pcapng writing off the reactor thread.
+
+    The reactor side only copies each serial chunk (with its arrival
+    time) into a SharedRing; a worker process decodes it, writes the
+    capture to output and sends summaries back, which show up in
+    .stats and are passed to on_report.  The SLIP stream has to be
+    decoded in order, so there's a single decode worker."""
+
+    def __init__(self, output=None, section=None, capacity=1 << 22,
+                 report_interval=0.1, recent=64, on_report=None,
+                 start_method='spawn', clock=reactor):
+        self._clock = clock
+        self._ring = SharedRing(capacity)
+        self._on_report = on_report
+        self.stats = {}
+        ctx = multiprocessing.get_context(start_method)
+        self._conn, child_conn = ctx.Pipe(duplex=False)
+        self._stop = ctx.Event()
+        self._proc = ctx.Process(target=_decode_worker, name="sharktoothle-decode",
+                                 args=(self._ring.name, output, section, child_conn,
+                                       self._stop, report_interval, recent),
+                                 daemon=True)
+        self._proc.start()
+        child_conn.close()
+        self._finished = False
+        self._clock.addReader(self)
+
+    @property
+    def ring(self):
+        return self._ring
+
+    def write(self, data):
+        """Queues a raw chunk for the worker; never blocks."""
+        return self._ring.put(data, time.time_ns())
+
+    def stop(self, timeout=5.0):
+        """Lets the worker drain the ring and finish the capture."""
+        self._stop.set()
+        self._proc.join(timeout)
+        while not self._finished and self._conn.poll():
+            self.doRead()
+        self._clock.removeReader(self)
+        self._ring.close()
+
+    # IReadDescriptor
+    def fileno(self):
+        return -1 if self._conn.closed else self._conn.fileno()
+
+    def logPrefix(self):
+        return "OffloadPipeline"
+
+    def doRead(self):
+        try:
+            while self._conn.poll():
+                report = self._conn.recv()
+                self.stats = report
+                self._finished = report['final']
+                if self._on_report is not None:
+                    self._on_report(report)
+        except EOFError:
+            self._clock.removeReader(self)
+            self._finished = True
+        return None
+
+    def connectionLost(self, reason):
+        pass
+
+
+class OffloadedSniffer(NordicSniffer):
+    """NordicSniffer whose received data goes to an OffloadPipeline
+    instead of being decoded on the reactor thread."""
+
+    def __init__(self, pipeline, port="/dev/ttyUSB0", baud=460800, **kwargs):
+        self._pipeline = pipeline
+        # Responses are decoded in the worker, so nothing here could see
+        # the firmware agree to a new rate
+        kwargs.setdefault('baud_rates', None)
+        super().__init__(port=port, baud=baud, **kwargs)
+
+    @property
+    def pipeline(self):
+        return self._pipeline
+
+    def rawDataReceived(self, recv_data):
+        self._pipeline.write(recv_data)
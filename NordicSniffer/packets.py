@@ -1,15 +1,89 @@
 from enum import IntEnum
-from time import time
+from time import time_ns
 import struct
-import re
+
+# CRC init used on the advertising channels; data channel connections
+# get theirs from the CONNECT_REQ.
+ADV_CRC_INIT = 0x555555
+
+def _reverse24(value):
+    return int('{:024b}'.format(value & 0xFFFFFF)[::-1], 2)
+
+def _crc24_table():
+    # The BLE CRC polynomial x^24 + x^10 + x^9 + x^6 + x^4 + x^3 + x + 1
+    # (0x00065B) is clocked in LSB first, so the table is built for the
+    # reflected form.
+    poly = _reverse24(0x00065B)
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ poly if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+CRC24_TABLE = _crc24_table()
+
+def ble_crc24(pdu, crc_init=ADV_CRC_INIT):
+    """Computes the link layer CRC over a PDU (header, length and
+    payload).  The result compares equal to the packet's three CRC bytes
+    read as a little-endian integer."""
+    table = CRC24_TABLE
+    crc = _reverse24(crc_init)
+    for byte in pdu:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+def check_crcs(packets, crc_init=ADV_CRC_INIT, trust_firmware=False):
+    """Verifies the CRCs on a list of packets in one call, returning a
+    list of bools.
+
+    packets can be BleLinkLayerPackets or SnifferPackets.  crc_init is
+    either a single value or a mapping of access address to CRC init for
+    the connections being followed (unknown addresses use the advertising
+    value).  With trust_firmware set, SnifferPackets the firmware already
+    flagged crc_ok aren't recomputed."""
+    table = CRC24_TABLE
+    per_aa = hasattr(crc_init, 'get')
+    reversed_inits = {}
+    results = []
+    for pkt in packets:
+        if isinstance(pkt, SnifferPacket):
+            if trust_firmware and pkt.crc_ok:
+                results.append(True)
+                continue
+            pkt = pkt.packet
+        init = crc_init.get(pkt.aa, ADV_CRC_INIT) if per_aa else crc_init
+        crc = reversed_inits.get(init)
+        if crc is None:
+            crc = reversed_inits[init] = _reverse24(init)
+        data = pkt._data
+        start = pkt._offset + BleLinkLayerPacket.HEADER
+        end = len(data) - 3
+        # header and length, then skip the padding byte
+        for idx in (start, start + 1):
+            crc = (crc >> 8) ^ table[(crc ^ data[idx]) & 0xFF]
+        for byte in memoryview(data)[start+3:end]:
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+        results.append(crc == int.from_bytes(data[end:], byteorder='little'))
+    return results
 
 class Packet:
-    def __init__(self, data, timestamp=time()):
+    """Base for the packet classes.  The buffer is kept as handed in
+    (usually the bytearray a frame was decoded into) along with the
+    offset this packet starts at, so packets nested inside a frame share
+    its buffer instead of copying out of it.  Slices of it are handed
+    out as memoryviews."""
+    __slots__ = ('_timestamp', '_data', '_offset')
+
+    def __init__(self, data, timestamp=None, offset=0):
         self._timestamp = timestamp
         self._data = data
+        self._offset = offset
 
     def __repr__(self):
-        return "{}({})".format(self.__class__, self._data)
+        data = None if self._data is None else bytes(self.data)
+        return "{}({})".format(self.__class__, data)
 
     @property
     def timestamp(self):
@@ -17,6 +91,8 @@ class Packet:
 
     @property
     def data(self):
+        if self._offset:
+            return memoryview(self._data)[self._offset:]
         return self._data
 
 class SnifferPacket(Packet):
@@ -27,10 +103,16 @@ class SnifferPacket(Packet):
     EC = 4
     TD = 6
 
-    def __init__(self, data):
-        if data is None or len(data) == 0:
+    # hlen, flags, channel, rssi, event counter, tdiff
+    HEADER_STRUCT = struct.Struct("<BBBBHI")
+
+    __slots__ = ('_hlen', '_flags', '_channel', '_rssi', '_ec', '_tdiff')
+
+    def __init__(self, data, offset=0):
+        if data is None or len(data) <= offset:
             raise ValueError("Missing Sniffer packet data!")
-        super().__init__(data)
+        super().__init__(data, offset=offset)
+        self._flags = None
 
     def __str__(self):
         dir_str = "\"M->S\"" if self.dir else "\"S->M\""
@@ -46,9 +128,17 @@ class SnifferPacket(Packet):
                      "tdiff={:d}>".format(self.tdiff) )
         return repString
 
+    def _unpack(self):
+        """Unpacks all of the header fields in one go; they're only
+        looked at once, the first time any of them is read."""
+        (self._hlen, self._flags, self._channel, self._rssi,
+         self._ec, self._tdiff) = self.HEADER_STRUCT.unpack_from(self._data, self._offset)
+
     @property
     def channel(self):
-        return self.header[self.CHANNEL]
+        if self._flags is None:
+            self._unpack()
+        return self._channel
 
     @property
     def crc_ok(self):
@@ -62,9 +152,9 @@ class SnifferPacket(Packet):
     @property
     def ec(self):
         """event counter"""
-        ec_offset = self.EC
-        raw_ec = self.header[ec_offset:ec_offset+2]
-        return int.from_bytes(raw_ec, byteorder='little')
+        if self._flags is None:
+            self._unpack()
+        return self._ec
 
     @property
     def encrypted(self):
@@ -74,16 +164,19 @@ class SnifferPacket(Packet):
     @property
     def flags(self):
         """raw flags byte"""
-        return self.header[self.FLAGS]
+        if self._flags is None:
+            self._unpack()
+        return self._flags
 
     @property
     def header(self):
-        return self.data[:self.hlen]
+        start = self._offset
+        return memoryview(self._data)[start:start+self.hlen]
 
     @property
     def hlen(self):
         """header length"""
-        return self.data[self.HLEN]
+        return self._data[self._offset + self.HLEN]
 
     @property
     def mic_ok(self):
@@ -92,41 +185,49 @@ class SnifferPacket(Packet):
 
     @property
     def packet(self):
-        return self.packet
+        """the link layer packet carried by this sniffer packet"""
+        return BleLinkLayerPacket(self._data, offset=self._offset + self.hlen)
 
     @property
     def payload(self):
-        return self.data[self.hlen:]
+        return memoryview(self._data)[self._offset + self.hlen:]
 
     @property
     def rssi(self):
         """rssi (in -dB)"""
-        return -self.header[self.RSSI]
+        if self._flags is None:
+            self._unpack()
+        return -self._rssi
 
     @property
     def tdiff(self):
         """difference in time between this and previous sniffer packet"""
-        td_offset = self.TD
-        rawTD = self.header[td_offset:td_offset+4]
-        return int.from_bytes(rawTD, byteorder='little')
+        if self._flags is None:
+            self._unpack()
+        return self._tdiff
 
 class BleLinkLayerPacket(Packet):
     AA = 0
     HEADER = 4
     LEN = 5
     PADDING = 6
-    PAYLOAD = 6
+    PAYLOAD = 7
 
-    def __init__(self, data):
-        # Documentation says the radio adds a padding byte
-        # that needs to be stripped out; so *zap*
-        del data[self.PADDING]
-        super().__init__(data)
+    # access address, header, length (the padding byte is skipped)
+    HEADER_STRUCT = struct.Struct("<IBB")
+
+    __slots__ = ('_aa', '_pdu_header', '_length')
+
+    def __init__(self, data, offset=0):
+        # Documentation says the radio adds a padding byte after the
+        # length; it's skipped over by offset rather than deleted.
+        super().__init__(data, offset=offset)
+        (self._aa, self._pdu_header,
+         self._length) = self.HEADER_STRUCT.unpack_from(data, offset)
 
     def __str__(self):
-        aa = "{:02x}:{:02x}:{:02x}:{:02x}".format(*self.aa)
         repString = ("<BleLinkLayerPacket; " +
-                     "aa=[{:s}], ".format(aa) +
+                     "aa=[{:08x}], ".format(self.aa) +
                      "crc=[{}], ".format(self.crc.hex()) +
                      "crc_calc=[{}], ".format(self.crc_ok()) +
                      "header={}>".format(self.header))
@@ -135,47 +236,49 @@ class BleLinkLayerPacket(Packet):
     @property
     def aa(self):
         """access address"""
-        aa_offset = self.AA
-        raw_access_address = self.data[aa_offset:aa_offset+4]
-        raw_access_address.reverse()
-        aa = list(raw_access_address)
-        return aa
+        return self._aa
 
     @property
     def header(self):
-        hdr_offset = self.AA+4
-        raw_hdr = int.from_bytes(self.data[hdr_offset:hdr_offset+2], byteorder='big')
+        raw_hdr = self._pdu_header
         pdu = {}
-        pdu['type'] = (raw_hdr & 0xF000) >> 12
-        pdu['length'] = (raw_hdr & 0xFC) >> 2
-        pdu['rxadd'] = (raw_hdr & 0x100) >> 16
-        pdu['txadd'] = (raw_hdr & 0x200) >> 17
+        pdu['type'] = raw_hdr & 0x0F
+        pdu['length'] = self._length
+        pdu['rxadd'] = (raw_hdr & 0x80) >> 7
+        pdu['txadd'] = (raw_hdr & 0x40) >> 6
         return pdu
 
+    @property
+    def pdu_type(self):
+        """PDU type (advertising) or LLID in the low bits (data channel)"""
+        return self._pdu_header & 0x0F
+
+    @property
+    def length(self):
+        """PDU payload length"""
+        return self._length
+
     @property
     def crc(self):
         """extracts the 3-byte CRC from the end of the packet"""
-        crc = self.data[-3:]
+        crc = memoryview(self._data)[-3:]
         return crc
 
+    @property
+    def pdu(self):
+        """PDU header, length and payload (everything the CRC covers)"""
+        start = self._offset
+        return bytes(self._data[start+self.HEADER:start+self.PADDING]) + self.payload
+
     # Calculate CRC over packet, compare to end
-    # FIXME - jbradach - this doesn't do anything close to the correct thing
-    def crc_ok(self):
+    def crc_ok(self, crc_init=ADV_CRC_INIT):
         """verify crc on packet"""
-        import crcmod
-        # These values came from dr. koopman's big page of CRC
-        # https://users.ece.cmu.edu/~koopman/crc/
-        crc_poly = 0x100065b
-        crc_bitrev = 0x1b4c001
-        crc_fnc = crcmod.Crc(crc_poly, initCrc=crc_bitrev, rev=True)
-        payload = self.data[self.HEADER:-3]
-        crc = crc_fnc.update(payload)
-    #    print("crc: {} vs {}".format(hex(crc.digest()), self.crc))
-        return crc
+        crc = ble_crc24(self.pdu, crc_init)
+        return crc == int.from_bytes(self.crc, byteorder='little')
 
     @property
     def payload(self):
-        payload = self.data[self.PAYLOAD:-3]
+        payload = memoryview(self._data)[self._offset + self.PAYLOAD:-3]
         return payload
 
 
@@ -204,8 +307,15 @@ class UartPacket(Packet):
     HLEN_DEFAULT = 6
     PROTOVER_DEFAULT = 1
 
-    def __init__(self, data=None, timestamp=int(time())):
+    # hlen, plen, protocol version, packet counter, id
+    HEADER_STRUCT = struct.Struct("<BBBHB")
+
+    __slots__ = ('_hlen', '_protover', '_count', '_id', '_payload')
+
+    def __init__(self, data=None, timestamp=None):
         # TODO - validate the packet!
+        if timestamp is None:
+            timestamp = time_ns() // 1000
         super().__init__(data, timestamp)
         if data is None:
             self._payload = bytearray()
@@ -213,13 +323,11 @@ class UartPacket(Packet):
             self._protover = UartPacket.PROTOVER_DEFAULT
             self._count = 0
         else:
-            self._hlen = data[UartPacket.HLEN_OFFSET]
-            self.id = data[UartPacket.ID_OFFSET]
-            self._payload = data[self.hlen:]
-            self._protover = data[UartPacket.PVER_OFFSET]
-            pc_offset = UartPacket.PC_OFFSET
-            raw_pc = self._data[pc_offset:pc_offset+2]
-            self._count = int.from_bytes(raw_pc, byteorder='little')
+            # The payload is sliced out of data on demand
+            self._payload = None
+            (self._hlen, _, self._protover, self._count,
+             pkt_id) = self.HEADER_STRUCT.unpack_from(data, self._offset)
+            self.id = pkt_id
 
     def __str__(self):
         packet_id = self.id
@@ -254,21 +362,49 @@ class UartPacket(Packet):
 
     @property
     def payload(self):
+        if self._payload is None:
+            return memoryview(self._data)[self._offset + self._hlen:]
         return self._payload
 
     @payload.setter
     def payload(self, data):
         self._payload = data
-        self._plen = len(data)
+
+    @property
+    def sniffer_packet(self):
+        """the SnifferPacket carried by an EVENT_PACKET, sharing this
+        packet's buffer"""
+        return SnifferPacket(self._data, offset=self._offset + self._hlen)
 
     @property
     def pc(self):
         "packet count"
         return self._count
 
+    @pc.setter
+    def pc(self, count):
+        self._count = count & 0xFFFF
+
+    @property
+    def as_bytearray(self):
+        """header and payload, unescaped; SlipPacket.encode() it to send
+        it to the sniffer"""
+        payload = self.payload
+        hdr = self.HEADER_STRUCT.pack(self._hlen, len(payload) & 0xFF, self._protover,
+                                      self._count, self._id)
+        out = bytearray(hdr)
+        # Any extra header bytes go out as they came in
+        if self._payload is None and self._hlen > len(hdr):
+            start = self._offset + len(hdr)
+            out.extend(self._data[start:self._offset + self._hlen])
+        out.extend(payload)
+        return out
+
     @property
     def plen(self):
         """payload length"""
+        if self._payload is None:
+            return len(self._data) - self._offset - self._hlen
         return len(self._payload)
 
     @property
@@ -277,69 +413,188 @@ class UartPacket(Packet):
         return self._protover
 
 class SlipPacket(Packet):
+    __slots__ = ()
+
     SLIP_START = 0xAB
     SLIP_END = 0xBC
     SLIP_ESC = 0xCD
     SLIP_ESC_START = 0xAC
     SLIP_ESC_END = 0xBD
     SLIP_ESC_ESC = 0xCE
-    SLIP_PKT_REGEX = b"\xab(?P<packet>.*?)(?!\xcd)\xbc"
-
-    re_slip_pkt = re.compile(SLIP_PKT_REGEX, re.DOTALL | re.MULTILINE)
 
     def __init__(self, data):
         super().__init__(data)
 
     @classmethod
     def find(cls, pbuf):
-        """Consumes the head of the packet buffer and spits out a
-        sniffer packet that has had the SlipPacket codes removed."""
-        packets = SlipPacket._extract_packets(pbuf)
-        return packets
+        """Consumes the complete frames at the head of the packet buffer
+        and spits out sniffer packets that have had the SlipPacket codes
+        removed.  A partial frame at the tail is left in pbuf."""
+        last_end = pbuf.rfind(cls.SLIP_END)
+        if last_end < 0:
+            return []
+        decoder = SlipDecoder()
+        frames = decoder.feed(bytes(pbuf[:last_end+1]))
+        del pbuf[:last_end+1]
+        return [SlipPacket(frame) for frame in frames]
 
     @classmethod
-    def _extract_packets(cls, pbuf):
-        packets = []
-        m = SlipPacket.re_slip_pkt.finditer(pbuf)
-
-        new_end = None
-        for pkt in m:
-            new_end = pkt.end()
-            unesc_pkt = cls._unescape_packet(pkt.group('packet'))
-            nsp = SlipPacket(unesc_pkt)
-            packets.append(nsp)
-
-        # Remove processed data from packet buffer
-        if (new_end is not None):
-            del pbuf[:new_end]
-
-        return packets
+    def encode(cls, frame):
+        """Escapes a frame and wraps it in start/end bytes, ready to go
+        out over the UART."""
+        return b'\xAB' + cls._escape_packet(frame) + b'\xBC'
 
     @staticmethod
     def _unescape_packet(pkt):
-        decode = {b'\xAC':b'\xAB',
-                  b'\xBD':b'\xBC',
-                  b'\xCE':b'\xCD'}
-        repl = lambda matchob: (
-            decode[matchob.group('esc')]
-        )
-
-        regexp = b'\xCD(?P<esc>.)'
-
-        stripped = re.sub(regexp, repl, pkt, re.DOTALL | re.MULTILINE)
-        return stripped
+        decoder = SlipDecoder()
+        frame = bytearray()
+        decoder._unescape_into(frame, bytes(pkt))
+        return frame
 
     @staticmethod
     def _escape_packet(pkt):
-        decode = {b'\xAB':b'\xAC',
-                  b'\xBC':b'\xBD',
-                  b'\xCD':b'\xCE'}
-        repl = lambda matchob: (
-            decode[matchob.group('esc')]
-        )
-        # XXX - jbradach - implement me; needs to match on
-        # all three.
-        regexp = b'\xCD(?P<esc>.)'
-
-        stripped = re.sub(regexp, repl, pkt, re.DOTALL | re.MULTILINE)
-        return stripped
+        """Replaces the start, end and escape bytes in pkt with their
+        escape sequences.  The escape byte has to go first so the
+        escapes added for the other two aren't escaped again."""
+        return (bytes(pkt).replace(b'\xCD', b'\xCD\xCE')
+                          .replace(b'\xAB', b'\xCD\xAC')
+                          .replace(b'\xBC', b'\xCD\xBD'))
+
+
+class SlipDecoder:
+    """Resumable SLIP decoder for the sniffer's UART stream.
+
+    Decoder state (whether we're inside a frame, whether the last byte
+    seen was an escape, and the partially unescaped frame) survives
+    between calls to feed(), so each chunk from the serial port is only
+    scanned once no matter how it splits the frames up."""
+    START = SlipPacket.SLIP_START
+    END = SlipPacket.SLIP_END
+    ESC = SlipPacket.SLIP_ESC
+    ESC_BYTE = bytes((SlipPacket.SLIP_ESC,))
+    UNESCAPE = {
+        SlipPacket.SLIP_ESC_START: SlipPacket.SLIP_START,
+        SlipPacket.SLIP_ESC_END: SlipPacket.SLIP_END,
+        SlipPacket.SLIP_ESC_ESC: SlipPacket.SLIP_ESC
+    }
+
+    def __init__(self, max_frame_len=65536):
+        self.max_frame_len = max_frame_len
+        self._in_frame = False
+        self._escape = False
+        self._frame = bytearray()
+        self.frames = 0
+        self.escapes = 0
+        self.errors = 0
+        self.discarded = 0
+        # frames thrown away whole (errors counts bad escapes as well)
+        self.dropped = 0
+
+    def reset(self):
+        """Drops any partial frame and waits for the next start byte."""
+        self.discarded += len(self._frame)
+        self._in_frame = False
+        self._escape = False
+        self._frame = bytearray()
+
+    @property
+    def in_frame(self):
+        return self._in_frame
+
+    @property
+    def pending(self):
+        """number of decoded bytes held for the frame in progress"""
+        return len(self._frame)
+
+    def feed(self, data):
+        """Decodes a chunk of raw UART data, returning a list of the
+        (unescaped) frames it completed."""
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        frames = []
+        pos = 0
+        size = len(data)
+        while pos < size:
+            if not self._in_frame:
+                start = data.find(self.START, pos)
+                if start < 0:
+                    self.discarded += size - pos
+                    break
+                self.discarded += start - pos
+                self._in_frame = True
+                pos = start + 1
+                continue
+
+            end = data.find(self.END, pos)
+            stop = size if end < 0 else end
+            # A start byte inside a frame means we lost its end; resync
+            # on the new frame rather than glue the two together.
+            restart = data.find(self.START, pos, stop)
+            if restart >= 0:
+                self._unescape_into(self._frame, data[pos:restart])
+                self.errors += 1
+                self.dropped += 1
+                self.reset()
+                self._in_frame = True
+                pos = restart + 1
+                continue
+
+            self._unescape_into(self._frame, data[pos:stop])
+            if len(self._frame) > self.max_frame_len:
+                self.errors += 1
+                self.dropped += 1
+                self.reset()
+                pos = stop
+                continue
+            if end < 0:
+                break
+
+            if self._escape:
+                # Escape byte immediately followed by the end byte
+                self.errors += 1
+                self.dropped += 1
+                self.reset()
+            else:
+                frames.append(self._frame)
+                self.frames += 1
+                self._frame = bytearray()
+                self._in_frame = False
+            pos = end + 1
+
+        return frames
+
+    def _unescape_into(self, frame, segment):
+        """Appends segment to frame, replacing escape sequences.  An
+        escape byte at the very end of segment is remembered so the
+        sequence can be finished by the next chunk."""
+        if len(segment) == 0:
+            return
+        if self._escape:
+            self._escape = False
+            frame.append(self._unescape_byte(segment[0]))
+            segment = segment[1:]
+        if self.ESC not in segment:
+            frame.extend(segment)
+            return
+        parts = segment.split(self.ESC_BYTE)
+        frame.extend(parts[0])
+        last = len(parts) - 1
+        for idx in range(1, len(parts)):
+            part = parts[idx]
+            if len(part) == 0:
+                if idx == last:
+                    # The escaped byte hasn't arrived yet.
+                    self._escape = True
+                else:
+                    self.errors += 1
+                continue
+            frame.append(self._unescape_byte(part[0]))
+            frame.extend(part[1:])
+
+    def _unescape_byte(self, code):
+        self.escapes += 1
+        try:
+            return self.UNESCAPE[code]
+        except KeyError:
+            self.errors += 1
+            return code
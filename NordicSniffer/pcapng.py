@@ -1,5 +1,10 @@
-from struct import pack
-from time import time
+import io
+import mmap
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from struct import Struct
+from time import time_ns
 from enum import IntEnum, unique
 
 @unique
@@ -28,6 +33,16 @@ class OptionCode(IntEnum):
     IF_FCSLEN = 13
     IF_TSOFFSET = 14
 
+@unique
+class IsbOptionCode(IntEnum):
+    ISB_STARTTIME = 2
+    ISB_ENDTIME = 3
+    ISB_IFRECV = 4
+    ISB_IFDROP = 5
+    ISB_FILTERACCEPT = 6
+    ISB_OSDROP = 7
+    ISB_USRDELIV = 8
+
 LINKTYPE_BLUETOOTH_LE_LL=251
 
 SHB_OPTION_HARDWARE = 2
@@ -35,6 +50,22 @@ SHB_OPTION_OS = 3
 SHB_OPTION_USERAPPL = 4
 
 
+# Precompiled layouts for the fixed parts of each block
+_U32 = Struct("@I")
+_BLOCK_HEADER = Struct("@II")
+_SHB_BODY = Struct("@IHHq")
+_IDB_BODY = Struct("@HHI")
+_EPB_HEADER = Struct("@IIIIIII")
+_EPB_TRAILER = Struct("@II")
+_OPTION_HEADER = Struct("@HH")
+_ISB_BODY = Struct("@III")
+_U64 = Struct("@Q")
+_TIMESTAMP = Struct("@II")
+
+# Block type, length, interface, timestamp (2), lengths (2) up front;
+# opt_endofopt and the trailing length at the end.
+EPB_OVERHEAD = _EPB_HEADER.size + _EPB_TRAILER.size
+
 def pad_to_width(data, width=4):
     """Pads data with '\0's so it aligns to width"""
     if (len(data) == 0 or (len(data) % width == 0)):
@@ -67,10 +98,9 @@ class Block:
 
     @property
     def as_bytearray(self):
-        bt = pack("@I", self._block_type)
         body = pad_to_width(self._body)
-        btl = pack("@I", len(self._body) + 12)
-        return (bt + btl + body + btl)
+        btl = len(body) + 12
+        return (_BLOCK_HEADER.pack(self._block_type, btl) + body + _U32.pack(btl))
 
 
 #    0                   1                   2                   3
@@ -103,6 +133,8 @@ class SectionHeaderBlock(Block):
         self._majver = majver
         self._minver = minver
         self._options = OptionList()
+        self._cache = None
+        self._cache_gen = None
 
     def add_opt(self, opt):
         self._options.add(opt)
@@ -121,14 +153,15 @@ class SectionHeaderBlock(Block):
 
     @property
     def as_bytearray(self):
-        bom = pack("@I", self._bom)
-        majver = pack("@H", self._majver)
-        minver = pack("@H", self._minver)
-        seclen = pack("@q", self._section_length)
-        options = self._options.as_bytearray
-
-        self._body = bytearray(bom + majver + minver + seclen + options)
-        return super().as_bytearray
+        """serialized block; built once and reused until the options change"""
+        options = self._options
+        if self._cache is None or self._cache_gen != options.generation:
+            fixed = _SHB_BODY.pack(self._bom, self._majver, self._minver,
+                                   self._section_length)
+            self._body = fixed + options.as_bytearray
+            self._cache = super().as_bytearray
+            self._cache_gen = options.generation
+        return self._cache
 
 #
 #     0                   1                   2                   3
@@ -150,11 +183,15 @@ class SectionHeaderBlock(Block):
 #    +---------------------------------------------------------------+
 class InterfaceDescriptionBlock(Block):
     _block_type = BlockType.IDB
-    def __init__(self, linktype, snaplen=0):
+    def __init__(self, linktype, snaplen=0, tsresol=6):
         self._linktype = linktype
         self._snaplen = snaplen
         self._options = OptionList()
-        pass
+        if tsresol is not None:
+            # Timestamps are in units of 10^-tsresol seconds
+            self._options.add(Option(OptionCode.IF_TSRESOL, bytes((tsresol,))))
+        self._cache = None
+        self._cache_gen = None
 
     @property
     def linktype(self):
@@ -170,12 +207,14 @@ class InterfaceDescriptionBlock(Block):
 
     @property
     def as_bytearray(self):
-        lt = pack("@H", self._linktype)
-        rsvd = pack("@H", 0)
-        sl = pack("@I", self._snaplen)
-        options = self._options.as_bytearray
-        self._body = bytearray(lt + rsvd + sl + options)
-        return super().as_bytearray
+        """serialized block; built once and reused until the options change"""
+        options = self._options
+        if self._cache is None or self._cache_gen != options.generation:
+            fixed = _IDB_BODY.pack(self._linktype, 0, self._snaplen)
+            self._body = fixed + options.as_bytearray
+            self._cache = super().as_bytearray
+            self._cache_gen = options.generation
+        return self._cache
 
 #    0                   1                   2                   3
 #    0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
@@ -207,7 +246,9 @@ class InterfaceDescriptionBlock(Block):
 #    +---------------------------------------------------------------+
 class EnhancedPacketBlock(Block):
     _block_type = BlockType.EPB
-    def __init__(self, pkt_data, timestamp=int(time()), iface_id=0):
+    def __init__(self, pkt_data, timestamp=None, iface_id=0):
+        if timestamp is None:
+            timestamp = time_ns() // 1000
         self._iface_id = iface_id
         self._timestamp = timestamp
         self._pkt_data = pkt_data
@@ -251,15 +292,114 @@ class EnhancedPacketBlock(Block):
 
     @property
     def as_bytearray(self):
-        iface_id = pack("@I", self._iface_id)
-        ts_high = pack("@I", self._timestamp >> 32)
-        ts_low = pack("@I", self._timestamp & 0xFFFFFFFF)
-        cpl = pack("@I", self._cap_pkt_len)
-        opl = pack("@I", self._orig_pkt_len)
-        pkt = pad_to_width(self._pkt_data)
+        data = self._pkt_data
+        plen = len(data)
+        padded = (plen + 3) & ~3
         options = self._options.as_bytearray
-        self._body = bytearray(iface_id + ts_high + ts_low +
-                               cpl + opl + pkt + options)
+        opt_start = _EPB_HEADER.size + padded
+        btl = opt_start + len(options) + 4
+        ts = self._timestamp
+        buf = bytearray(btl)
+        _EPB_HEADER.pack_into(buf, 0, self._block_type, btl, self._iface_id,
+                              ts >> 32, ts & 0xFFFFFFFF,
+                              self._cap_pkt_len, self._orig_pkt_len)
+        buf[_EPB_HEADER.size:_EPB_HEADER.size+plen] = data
+        buf[opt_start:btl-4] = options
+        _U32.pack_into(buf, btl-4, btl)
+        return buf
+
+def encode_epbs(packets, iface_id=0):
+    """Serializes a batch of packets as consecutive EPBs.
+
+    All of the blocks are packed straight into one preallocated buffer,
+    which is returned.  The output is the same as concatenating
+    create_epb(pkt).as_bytearray for each packet."""
+    datas = [pkt.data for pkt in packets]
+    total = 0
+    for data in datas:
+        total += EPB_OVERHEAD + ((len(data) + 3) & ~3)
+    buf = bytearray(total)
+
+    pack_header = _EPB_HEADER.pack_into
+    pack_trailer = _EPB_TRAILER.pack_into
+    hsize = _EPB_HEADER.size
+    block_type = BlockType.EPB.value
+    pos = 0
+    for pkt, data in zip(packets, datas):
+        plen = len(data)
+        padded = (plen + 3) & ~3
+        btl = EPB_OVERHEAD + padded
+        ts = pkt.timestamp
+        pack_header(buf, pos, block_type, btl, iface_id,
+                    ts >> 32, ts & 0xFFFFFFFF, plen, plen)
+        start = pos + hsize
+        buf[start:start+plen] = data
+        # opt_endofopt is all zeroes, same as the padding
+        pack_trailer(buf, start + padded, 0, btl)
+        pos += btl
+    return buf
+
+#    0                   1                   2                   3
+#    0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+#    +---------------------------------------------------------------+
+#  0 |                    Block Type = 0x00000005                    |
+#    +---------------------------------------------------------------+
+#  4 |                      Block Total Length                       |
+#    +---------------------------------------------------------------+
+#  8 |                         Interface ID                          |
+#    +---------------------------------------------------------------+
+# 12 |                        Timestamp (High)                       |
+#    +---------------------------------------------------------------+
+# 16 |                        Timestamp (Low)                        |
+#    +---------------------------------------------------------------+
+# 20 /                                                               /
+#    /                      Options (variable)                       /
+#    /                                                               /
+#    +---------------------------------------------------------------+
+#    |                      Block Total Length                       |
+#    +---------------------------------------------------------------+
+class InterfaceStatisticsBlock(Block):
+    """Capture statistics for one interface.  The counters cover the
+    time from starttime up to the block's own timestamp; any that are
+    None are left out."""
+    _block_type = BlockType.ISB
+
+    def __init__(self, iface_id=0, timestamp=None, starttime=None, endtime=None,
+                 ifrecv=None, ifdrop=None, osdrop=None, usrdeliv=None, filteraccept=None):
+        if timestamp is None:
+            timestamp = time_ns() // 1000
+        self._iface_id = iface_id
+        self._timestamp = timestamp
+        self._options = OptionList()
+        for code, stamp in ((IsbOptionCode.ISB_STARTTIME, starttime),
+                            (IsbOptionCode.ISB_ENDTIME, endtime)):
+            if stamp is not None:
+                self._options.add(Option(code, _TIMESTAMP.pack(stamp >> 32, stamp & 0xFFFFFFFF)))
+        for code, count in ((IsbOptionCode.ISB_IFRECV, ifrecv),
+                            (IsbOptionCode.ISB_IFDROP, ifdrop),
+                            (IsbOptionCode.ISB_FILTERACCEPT, filteraccept),
+                            (IsbOptionCode.ISB_OSDROP, osdrop),
+                            (IsbOptionCode.ISB_USRDELIV, usrdeliv)):
+            if count is not None:
+                self._options.add(Option(code, _U64.pack(count)))
+
+    @property
+    def iface_id(self):
+        return self._iface_id
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @property
+    def options(self):
+        return self._options
+
+    @property
+    def as_bytearray(self):
+        ts = self._timestamp
+        self._body = (_ISB_BODY.pack(self._iface_id, ts >> 32, ts & 0xFFFFFFFF) +
+                      self._options.as_bytearray)
         return super().as_bytearray
 
 #  0                   1                   2                   3
@@ -283,6 +423,8 @@ class OptionList:
 
     def __init__(self):
         self._options = []
+        self._cache = None
+        self._generation = 0
 
     def add(self, options):
         try:
@@ -290,21 +432,33 @@ class OptionList:
                 self._options.append(option)
         except TypeError:
             self._options.append(options)
+        self._cache = None
+        self._generation += 1
         return self
 
     @property
-    def as_bytearray(self):
-        options_list = bytearray()
-        for opt in self._options:
-            options_list.extend(opt.as_bytearray)
-        options_list.extend(OptionEnd().as_bytearray)
+    def generation(self):
+        """bumped every time the list changes; lets blocks know when
+        their cached serialization is stale"""
+        return self._generation
 
-        return options_list
+    @property
+    def as_bytearray(self):
+        if self._cache is None:
+            options_list = bytearray()
+            for opt in self._options:
+                options_list.extend(opt.as_bytearray)
+            options_list.extend(OPTION_END)
+            self._cache = bytes(options_list)
+        return self._cache
 
 class Option:
     def __init__(self, code, value):
+        """value is either a str (stored as UTF-8) or raw bytes"""
         self._code = code
-        self._value = bytearray(value, 'utf-8')
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        self._value = bytearray(value)
 
     @property
     def code(self):
@@ -320,10 +474,8 @@ class Option:
 
     @property
     def as_bytearray(self):
-        oc = pack("@H", self._code)
-        ol = pack("@H", len(self._value))
         ov = pad_to_width(self._value)
-        return bytearray(oc + ol + ov)
+        return bytearray(_OPTION_HEADER.pack(self._code, len(self._value)) + ov)
 
 class OptionComment(Option):
     def __init__(self, comment):
@@ -337,6 +489,8 @@ class OptionEnd(Option):
     def __init__(self):
         super().__init__(code=0, value="")
 
+OPTION_END = bytes(OptionEnd().as_bytearray)
+
 # p = Packetizer()
 # p.add(Packet)
 # p.write(<filename>)
@@ -345,9 +499,16 @@ class Section:
     def __init__(self, linktype):
         self._pkts = []
         self._shb = SectionHeaderBlock()
-        self._idb = InterfaceDescriptionBlock(linktype)
+        self._idbs = [InterfaceDescriptionBlock(linktype)]
         self._dropcount = 0
 
+    def add_interface(self, linktype):
+        """Adds another IDB to the section; EPBs refer to interfaces by
+        their position in idbs."""
+        idb = InterfaceDescriptionBlock(linktype)
+        self._idbs.append(idb)
+        return idb
+
     def add_packet(self, packet):
         self._pkts.append(packet)
 
@@ -365,20 +526,350 @@ class Section:
 
     @property
     def idb(self):
-        return self._idb
+        return self._idbs[0]
+
+    @property
+    def idbs(self):
+        return self._idbs
 
     @property
     def pkts(self):
         return self._pkts
 
+    @property
+    def header_bytes(self):
+        """the SHB followed by every IDB; what a capture starts with"""
+        header = bytearray(self._shb.as_bytearray)
+        for idb in self._idbs:
+            header.extend(idb.as_bytearray)
+        return header
+
     @property
     def as_bytearray(self):
-        shb = self._shb.as_bytearray
-        idb = self._idb.as_bytearray
-        pkts = bytearray()
+        pkts = self.header_bytes
         for pkt in self._pkts:
             pkts.extend(pkt.as_bytearray)
-        return (shb + idb + pkts)
+        if self._dropcount:
+            pkts.extend(InterfaceStatisticsBlock(ifrecv=len(self._pkts) + self._dropcount,
+                                                 ifdrop=self._dropcount).as_bytearray)
+        return pkts
 
 def create_epb(packet, iface_id=0):
     epb = EnhancedPacketBlock(packet.data, timestamp=packet.timestamp, iface_id=iface_id)
+    return epb
+
+class PcapngStreamWriter:
+    """Streams a capture to a file as packets arrive.
+
+    The section header and interface description blocks are taken from
+    a Section and written once; after that every packet is serialized
+    and appended on its own, so nothing about the capture is kept in
+    memory.  stream can be a path or a binary file object; unbuffered
+    file objects get wrapped in a BufferedWriter.  With append set, a
+    path that already holds a capture (written with the same section)
+    is carried on with rather than truncated, and the header isn't
+    written again."""
+
+    def __init__(self, stream, section, buffer_size=io.DEFAULT_BUFFER_SIZE, append=False):
+        if isinstance(stream, str):
+            stream = open(stream, 'ab' if append else 'wb', buffering=buffer_size)
+            self._owns_stream = True
+        else:
+            if isinstance(stream, io.RawIOBase):
+                stream = io.BufferedWriter(stream, buffer_size=buffer_size)
+            self._owns_stream = False
+        self._stream = stream
+        self._section = section
+        self._bytes_written = 0
+        self._packets_written = 0
+        self._closed = False
+        if append and stream.tell() > 0:
+            return
+        self.write_block(section.shb)
+        for idb in section.idbs:
+            self.write_block(idb)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def section(self):
+        return self._section
+
+    @property
+    def bytes_written(self):
+        return self._bytes_written
+
+    @property
+    def packets_written(self):
+        return self._packets_written
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def write_block(self, block):
+        """Appends an already-built block to the capture."""
+        if self._closed:
+            raise ValueError("write to closed PcapngStreamWriter")
+        data = block.as_bytearray
+        self._stream.write(data)
+        self._bytes_written += len(data)
+        if block.block_type == BlockType.EPB:
+            self._packets_written += 1
+
+    def write_isb(self, iface_id=0, **stats):
+        """Appends an InterfaceStatisticsBlock; stats are its keyword
+        arguments (timestamp, starttime, ifrecv, ifdrop, ...)."""
+        self.write_block(InterfaceStatisticsBlock(iface_id, **stats))
+
+    def write_packet(self, packet, iface_id=0):
+        """Wraps a decoded packet in an EPB and appends it."""
+        self.write_block(create_epb(packet, iface_id=iface_id))
+
+    def write_packets(self, packets, iface_id=0):
+        """Appends a batch of packets with a single write."""
+        if self._closed:
+            raise ValueError("write to closed PcapngStreamWriter")
+        data = encode_epbs(packets, iface_id=iface_id)
+        self._stream.write(data)
+        self._bytes_written += len(data)
+        self._packets_written += len(packets)
+
+    def flush(self):
+        """Pushes buffered blocks out to the underlying file."""
+        if not self._closed:
+            self._stream.flush()
+
+    def close(self):
+        """Flushes the capture; the file is closed only if the writer
+        opened it."""
+        if self._closed:
+            return
+        self._stream.flush()
+        if self._owns_stream:
+            self._stream.close()
+        self._closed = True
+
+
+# One packet out of a PcapngReader; data is a memoryview into the file
+CapturedPacket = namedtuple('CapturedPacket', ['iface_id', 'timestamp', 'data'])
+
+# Interface Description Block contents, as seen by a PcapngReader
+InterfaceInfo = namedtuple('InterfaceInfo', ['linktype', 'snaplen', 'tsresol'])
+
+# Interface Statistics Block contents; counters the block didn't have are None
+InterfaceStatistics = namedtuple('InterfaceStatistics',
+                                 ['iface_id', 'timestamp', 'starttime', 'endtime',
+                                  'ifrecv', 'ifdrop', 'osdrop', 'usrdeliv',
+                                  'filteraccept'])
+
+class PcapngReader:
+    """Random access to the packets in a pcapng capture.
+
+    The file is mmap'd and only block headers are walked; each EPB's
+    offset goes into an index the first time it's needed, so opening
+    even a huge capture is instant and reader[n] / seek_time() only
+    scan as far as they have to.  Packet data comes back as memoryviews
+    into the mapping, which can go straight into UartPacket and friends
+    (see packets()).  Timestamps are left in the capture's own units
+    (if_tsresol, microseconds unless the IDB says otherwise)."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("{} is empty".format(path))
+        self._view = memoryview(self._mmap)
+        self._offsets = array('Q')
+        self._timestamps = array('Q')
+        self._interfaces = []
+        self._isb_offsets = []
+        # (file offset, first interface number, byte order) for each section
+        self._sections = []
+        self._section_offsets = []
+        self._endian = None
+        self._scan_pos = 0
+        self._complete = False
+        if self._view[0:4] != _SHB_MAGIC:
+            self.close()
+            raise ValueError("{} isn't a pcapng file".format(path))
+        self._scan(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        self._scan()
+        return len(self._offsets)
+
+    def __iter__(self):
+        idx = 0
+        while True:
+            self._scan(idx + 1)
+            if idx >= len(self._offsets):
+                return
+            yield self._packet_at(idx)
+            idx += 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        elif idx >= len(self._offsets):
+            self._scan(idx + 1)
+        if not 0 <= idx < len(self._offsets):
+            raise IndexError("capture index out of range")
+        return self._packet_at(idx)
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Packets handed out still point into the mapping; it goes
+            # away when they do.
+            pass
+        self._file.close()
+
+    @property
+    def interfaces(self):
+        """InterfaceInfo for every IDB seen so far"""
+        return self._interfaces
+
+    def statistics(self):
+        """InterfaceStatistics for every ISB in the capture"""
+        self._scan()
+        return [self._isb_at(offset) for offset in self._isb_offsets]
+
+    def seek_time(self, timestamp):
+        """Index of the first packet at or after timestamp (captures are
+        assumed to be in time order)."""
+        stamps = self._timestamps
+        while not self._complete and (len(stamps) == 0 or stamps[-1] < timestamp):
+            self._scan(len(stamps) + 1024)
+        return bisect_left(stamps, timestamp)
+
+    def packets(self, start=0, stop=None):
+        """Yields the captured packets in [start, stop) as UartPackets."""
+        from .packets import UartPacket
+        idx = start
+        while stop is None or idx < stop:
+            self._scan(idx + 1)
+            if idx >= len(self._offsets):
+                return
+            pkt = self._packet_at(idx)
+            yield UartPacket(pkt.data, timestamp=pkt.timestamp)
+            idx += 1
+
+    def _packet_at(self, idx):
+        offset = self._offsets[idx]
+        section = bisect_right(self._section_offsets, offset) - 1
+        _, iface_base, endian = self._sections[section]
+        header = _EPB_HEADERS[endian]
+        (_, _, iface_id, ts_high, ts_low,
+         cap_len, _) = header.unpack_from(self._view, offset)
+        start = offset + header.size
+        data = self._view[start:start+cap_len]
+        return CapturedPacket(iface_base + iface_id, (ts_high << 32) | ts_low, data)
+
+    def _scan(self, want=None):
+        """Walks block headers until want packets are indexed (or the end
+        of the file)."""
+        view = self._view
+        size = len(view)
+        pos = self._scan_pos
+        offsets = self._offsets
+        stamps = self._timestamps
+        endian = self._endian
+        block_header = _BLOCK_HEADERS.get(endian)
+        epb_stamp = _EPB_STAMPS.get(endian)
+        epb = BlockType.EPB
+        while not self._complete and (want is None or len(offsets) < want):
+            if pos + 12 > size:
+                self._complete = True
+                break
+            # The SHB block type reads the same in either byte order
+            if view[pos:pos+4] == _SHB_MAGIC:
+                bom = view[pos+8:pos+12].tobytes()
+                endian = '<' if bom == b'\x4d\x3c\x2b\x1a' else '>'
+                block_header = _BLOCK_HEADERS[endian]
+                epb_stamp = _EPB_STAMPS[endian]
+                self._endian = endian
+                self._sections.append((pos, len(self._interfaces), endian))
+                self._section_offsets.append(pos)
+            block_type, btl = block_header.unpack_from(view, pos)
+            if btl < 12 or pos + btl > size:
+                # Truncated, e.g. a capture that's still being written
+                self._complete = True
+                break
+            if block_type == epb:
+                ts_high, ts_low = epb_stamp.unpack_from(view, pos + 12)
+                offsets.append(pos)
+                stamps.append((ts_high << 32) | ts_low)
+            elif block_type == BlockType.IDB:
+                self._interfaces.append(self._parse_idb(endian, pos, btl))
+            elif block_type == BlockType.ISB:
+                self._isb_offsets.append(pos)
+            pos += btl
+        self._scan_pos = pos
+
+    def _isb_at(self, offset):
+        section = bisect_right(self._section_offsets, offset) - 1
+        _, iface_base, endian = self._sections[section]
+        view = self._view
+        _, btl = _BLOCK_HEADERS[endian].unpack_from(view, offset)
+        iface_id, ts_high, ts_low = _ISB_BODIES[endian].unpack_from(view, offset + 8)
+        values = {}
+        opt = offset + 20
+        end = offset + btl - 4
+        opt_header = _OPTION_HEADERS[endian]
+        while opt + 4 <= end:
+            code, length = opt_header.unpack_from(view, opt)
+            if code == 0:
+                break
+            if code in (IsbOptionCode.ISB_STARTTIME, IsbOptionCode.ISB_ENDTIME) and length == 8:
+                high, low = _EPB_STAMPS[endian].unpack_from(view, opt + 4)
+                values[code] = (high << 32) | low
+            elif length == 8:
+                values[code] = _U64S[endian].unpack_from(view, opt + 4)[0]
+            opt += 4 + ((length + 3) & ~3)
+        return InterfaceStatistics(iface_base + iface_id, (ts_high << 32) | ts_low,
+                                   values.get(IsbOptionCode.ISB_STARTTIME),
+                                   values.get(IsbOptionCode.ISB_ENDTIME),
+                                   values.get(IsbOptionCode.ISB_IFRECV),
+                                   values.get(IsbOptionCode.ISB_IFDROP),
+                                   values.get(IsbOptionCode.ISB_OSDROP),
+                                   values.get(IsbOptionCode.ISB_USRDELIV),
+                                   values.get(IsbOptionCode.ISB_FILTERACCEPT))
+
+    def _parse_idb(self, endian, pos, btl):
+        linktype, _, snaplen = _IDB_BODIES[endian].unpack_from(self._view, pos + 8)
+        tsresol = 6
+        opt = pos + 16
+        end = pos + btl - 4
+        opt_header = _OPTION_HEADERS[endian]
+        while opt + 4 <= end:
+            code, length = opt_header.unpack_from(self._view, opt)
+            if code == 0:
+                break
+            if code == OptionCode.IF_TSRESOL and length >= 1:
+                tsresol = self._view[opt + 4]
+            opt += 4 + ((length + 3) & ~3)
+        return InterfaceInfo(linktype, snaplen, tsresol)
+
+_SHB_MAGIC = b'\x0a\x0d\x0d\x0a'
+_BLOCK_HEADERS = {e: Struct(e + "II") for e in '<>'}
+_EPB_HEADERS = {e: Struct(e + "IIIIIII") for e in '<>'}
+_EPB_STAMPS = {e: Struct(e + "II") for e in '<>'}
+_IDB_BODIES = {e: Struct(e + "HHI") for e in '<>'}
+_OPTION_HEADERS = {e: Struct(e + "HH") for e in '<>'}
+_ISB_BODIES = {e: Struct(e + "III") for e in '<>'}
+_U64S = {e: Struct(e + "Q") for e in '<>'}
@@ -0,0 +1,177 @@
+import errno
+import os
+import stat
+from collections import deque
+from twisted.internet import reactor
+from twisted.internet.interfaces import IWriteDescriptor
+from twisted.logger import Logger
+from zope.interface import implementer
+from .pcapng import create_epb, encode_epbs
+
+log = Logger(namespace="PcapngPipe")
+
+@implementer(IWriteDescriptor)
+class PcapngPipeSink:
+    """Streams decoded packets to Wireshark through a named pipe.
+
+    Hook it up with NordicSniffer.add_sink() and point Wireshark at the
+    FIFO (wireshark -k -i <path>).  Writes are non-blocking and driven by
+    the reactor; while Wireshark is slow the EPBs wait in a queue capped
+    at max_pending bytes, and anything that doesn't fit is dropped (and
+    counted) so serial reads never stall.  When Wireshark goes away the
+    sink waits for the next reader and starts it off with a fresh section
+    header."""
+
+    def __init__(self, path, section, max_pending=1 << 20,
+                 retry_interval=0.5, clock=reactor):
+        self._path = path
+        self._section = section
+        self._max_pending = max_pending
+        self._retry_interval = retry_interval
+        self._clock = clock
+        self._fd = None
+        self._created_fifo = False
+        self._retry_call = None
+        self._writing = False
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._head_offset = 0
+        self.connects = 0
+        self.bytes_written = 0
+        self.packets_written = 0
+        self.bytes_dropped = 0
+        self.packets_dropped = 0
+        self.packets_skipped = 0
+
+    def __repr__(self):
+        return "PcapngPipeSink({})".format(self._path)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def connected(self):
+        return self._fd is not None
+
+    @property
+    def pending_bytes(self):
+        return self._pending_bytes
+
+    def start(self):
+        """Creates the FIFO (if needed) and starts waiting for a reader."""
+        try:
+            os.mkfifo(self._path)
+            self._created_fifo = True
+        except FileExistsError:
+            if not stat.S_ISFIFO(os.stat(self._path).st_mode):
+                raise ValueError("{} exists and isn't a FIFO".format(self._path))
+        self._try_open()
+
+    def stop(self):
+        if self._retry_call is not None and self._retry_call.active():
+            self._retry_call.cancel()
+        self._retry_call = None
+        self._disconnect(reopen=False)
+        if self._created_fifo:
+            os.unlink(self._path)
+            self._created_fifo = False
+
+    def write_packet(self, packet, iface_id=0):
+        if self._fd is None:
+            self.packets_skipped += 1
+            return
+        self._send(create_epb(packet, iface_id=iface_id).as_bytearray, 1)
+
+    def write_packets(self, packets, iface_id=0):
+        if self._fd is None:
+            self.packets_skipped += len(packets)
+            return
+        self._send(encode_epbs(packets, iface_id=iface_id), len(packets))
+
+    # IWriteDescriptor
+    def fileno(self):
+        return -1 if self._fd is None else self._fd
+
+    def logPrefix(self):
+        return repr(self)
+
+    def doWrite(self):
+        pending = self._pending
+        while pending:
+            data, npkts = pending[0]
+            try:
+                sent = os.write(self._fd, memoryview(data)[self._head_offset:])
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno != errno.EPIPE:
+                    log.error("pipe write failed: {err}", err=e)
+                self._disconnect(reopen=True)
+                return None
+            self.bytes_written += sent
+            self._head_offset += sent
+            if self._head_offset < len(data):
+                break
+            pending.popleft()
+            self._pending_bytes -= len(data)
+            self._head_offset = 0
+            self.packets_written += npkts
+
+        if pending and not self._writing:
+            self._clock.addWriter(self)
+            self._writing = True
+        elif not pending and self._writing:
+            self._clock.removeWriter(self)
+            self._writing = False
+        return None
+
+    def connectionLost(self, reason):
+        self._disconnect(reopen=True)
+
+    def _send(self, data, npkts):
+        if self._pending_bytes + len(data) > self._max_pending:
+            self.packets_dropped += npkts
+            self.bytes_dropped += len(data)
+            return
+        self._queue(data, npkts)
+        if not self._writing:
+            self.doWrite()
+
+    def _queue(self, data, npkts):
+        self._pending.append((data, npkts))
+        self._pending_bytes += len(data)
+
+    def _try_open(self):
+        self._retry_call = None
+        try:
+            fd = os.open(self._path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # ENXIO: nobody has the read end open yet
+            if e.errno != errno.ENXIO:
+                log.error("can't open {path}: {err}", path=self._path, err=e)
+            self._retry_call = self._clock.callLater(self._retry_interval, self._try_open)
+            return
+        self._fd = fd
+        self.connects += 1
+        log.info("reader connected to {path}", path=self._path)
+        self._queue(bytes(self._section.header_bytes), 0)
+        self.doWrite()
+
+    def _disconnect(self, reopen):
+        if self._writing:
+            self._clock.removeWriter(self)
+            self._writing = False
+        for data, npkts in self._pending:
+            if npkts:
+                self.packets_dropped += npkts
+                self.bytes_dropped += len(data)
+        self._pending.clear()
+        self._pending_bytes = 0
+        self._head_offset = 0
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            log.info("reader disconnected from {path}", path=self._path)
+        if reopen and self._retry_call is None:
+            self._retry_call = self._clock.callLater(self._retry_interval, self._try_open)
@@ -0,0 +1,199 @@
+import io
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from twisted.internet import reactor
+from twisted.logger import Logger
+from .pcapng import BlockType, InterfaceStatisticsBlock, create_epb, encode_epbs
+
+log = Logger(namespace="RotatingPcapng")
+
+class RotatingPcapngWriter:
+    """PcapngStreamWriter that spreads a capture over a ring of files,
+    like dumpcap's -b filesize:/duration:/files: options.
+
+    A new file is started before one would grow past max_size bytes or
+    once it's been open for max_duration seconds, and only the latest
+    max_files are kept (None for no limit on any of them).  The duration
+    is timed on clock, so files roll over on time even when nothing is
+    arriving; one that's still empty then is kept open and its time
+    starts again.  Each file
+    gets its own copy of section's header.  Files are named after path
+    with a sequence number and start time added, as dumpcap does
+    (cap_00001_20240101120000.pcapng).
+
+    A file is written under a temporary name (.part on the end) and
+    only renamed to its real name once it's complete, so anything
+    watching the directory never sees half a capture.  Flushing it to
+    disk, the rename and deleting the oldest file all happen on a
+    background thread, so a rollover never holds up packets."""
+
+    def __init__(self, path, section, max_size=None, max_duration=None, max_files=None,
+                 buffer_size=io.DEFAULT_BUFFER_SIZE, clock=reactor):
+        if max_files is not None and max_files < 1:
+            raise ValueError("max_files must be at least 1")
+        if max_size is not None and max_size <= len(section.header_bytes):
+            raise ValueError("max_size doesn't leave room for any packets")
+        self._stem, self._ext = os.path.splitext(path)
+        if not self._ext:
+            self._ext = '.pcapng'
+        self._section = section
+        self.max_size = max_size
+        self.max_duration = max_duration
+        self.max_files = max_files
+        self._buffer_size = buffer_size
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="sharktoothle-rotate")
+        self._finished = deque()
+        self._stream = None
+        self._path = None
+        self._file_bytes = 0
+        self._file_packets = 0
+        self._timer = None
+        self._bytes_written = 0
+        self._packets_written = 0
+        self._closed = False
+        self.file_count = 0
+        self.rotations = 0
+        self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def section(self):
+        return self._section
+
+    @property
+    def path(self):
+        """final name of the file being written"""
+        return self._path
+
+    @property
+    def files(self):
+        """completed files still on disk, oldest first"""
+        return list(self._finished)
+
+    @property
+    def bytes_written(self):
+        return self._bytes_written
+
+    @property
+    def packets_written(self):
+        return self._packets_written
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _open(self):
+        self.file_count += 1
+        self._path = "{}_{:05d}_{}{}".format(self._stem, self.file_count,
+                                             time.strftime("%Y%m%d%H%M%S"), self._ext)
+        self._stream = open(self._path + '.part', 'wb', buffering=self._buffer_size)
+        self._file_bytes = 0
+        self._file_packets = 0
+        self._arm_timer()
+        self._write(self._section.header_bytes, 0)
+
+    def rotate(self):
+        """Finishes the current file and starts the next one."""
+        if self._closed:
+            raise ValueError("rotate on closed RotatingPcapngWriter")
+        self._finish(keep=None if self.max_files is None else self.max_files - 1)
+        self.rotations += 1
+        self._open()
+
+    def _arm_timer(self):
+        if self.max_duration is not None:
+            self._timer = self._clock.callLater(self.max_duration, self._duration_up)
+
+    def _duration_up(self):
+        self._timer = None
+        if self._file_packets:
+            self.rotate()
+        else:
+            self._arm_timer()
+
+    def _finish(self, keep):
+        """Hands the current file over to the background thread, along
+        with whatever's beyond the newest keep completed files"""
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        stream, path = self._stream, self._path
+        self._stream = None
+        self._finished.append(path)
+        expired = []
+        if keep is not None:
+            while len(self._finished) > keep:
+                expired.append(self._finished.popleft())
+        future = self._executor.submit(_finish_file, stream, path, expired)
+        future.add_done_callback(_log_failure)
+
+    def _write(self, data, packets):
+        self._stream.write(data)
+        self._file_bytes += len(data)
+        self._file_packets += packets
+        self._bytes_written += len(data)
+        self._packets_written += packets
+
+    def _room_for(self, size):
+        """Rotates first if size more bytes shouldn't go in this file"""
+        if self._closed:
+            raise ValueError("write to closed RotatingPcapngWriter")
+        if not self._file_packets:
+            return
+        if self.max_size is not None and self._file_bytes + size > self.max_size:
+            self.rotate()
+
+    def write_block(self, block):
+        """Appends an already-built block to the current file."""
+        data = block.as_bytearray
+        self._room_for(len(data))
+        self._write(data, 1 if block.block_type == BlockType.EPB else 0)
+
+    def write_isb(self, iface_id=0, **stats):
+        self.write_block(InterfaceStatisticsBlock(iface_id, **stats))
+
+    def write_packet(self, packet, iface_id=0):
+        self.write_block(create_epb(packet, iface_id=iface_id))
+
+    def write_packets(self, packets, iface_id=0):
+        """Appends a batch of packets; a batch isn't split between files."""
+        data = encode_epbs(packets, iface_id=iface_id)
+        self._room_for(len(data))
+        self._write(data, len(packets))
+
+    def flush(self):
+        if not self._closed:
+            self._stream.flush()
+
+    def close(self):
+        """Finishes the last file and waits for the background work."""
+        if self._closed:
+            return
+        self._closed = True
+        self._finish(keep=self.max_files)
+        self._executor.shutdown(wait=True)
+
+def _finish_file(stream, path, expired):
+    stream.flush()
+    os.fsync(stream.fileno())
+    stream.close()
+    os.replace(path + '.part', path)
+    for old in expired:
+        try:
+            os.remove(old)
+        except FileNotFoundError:
+            pass
+
+def _log_failure(future):
+    err = future.exception()
+    if err is not None:
+        log.error("finishing a capture file failed: {err}", err=err)
@@ -0,0 +1,352 @@
+import errno
+import os
+from abc import ABC, abstractmethod
+import random
+import tty
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import IPushProducer, ITransport
+from twisted.logger import Logger
+from zope.interface import implementer
+from .packets import (ADV_CRC_INIT, SlipDecoder, SlipPacket, SnifferPacket, UartPacket,
+                      UartPacketIds, ble_crc24)
+
+log = Logger(namespace="SnifferSimulator")
+
+ADV_ACCESS_ADDRESS = 0x8E89BED6
+FIRMWARE_VERSION = b'\x11\x02'
+SLIP_SPECIALS = (SlipPacket.SLIP_START, SlipPacket.SLIP_END, SlipPacket.SLIP_ESC)
+
+# Stream building
+def build_uart_frame(pkt_id, payload, pc=0, protover=UartPacket.PROTOVER_DEFAULT):
+    """Raw (unescaped) UART packet: header followed by payload."""
+    hdr = UartPacket.HEADER_STRUCT.pack(UartPacket.HLEN_DEFAULT, len(payload) & 0xFF,
+                                        protover, pc & 0xFFFF, pkt_id)
+    return hdr + bytes(payload)
+
+def build_event_packet(pc=0, pdu=b'', aa=ADV_ACCESS_ADDRESS, pdu_type=0x0,
+                       channel=37, rssi=60, ec=0, tdiff=0, flags=0x01,
+                       crc_init=ADV_CRC_INIT):
+    """EVENT_PACKET frame carrying a link layer packet with a valid CRC
+    (unless flags says otherwise)."""
+    header = bytes((pdu_type & 0xFF, len(pdu) & 0xFF))
+    crc = ble_crc24(header + bytes(pdu), crc_init)
+    if not flags & 0x01:
+        crc ^= 0x1
+    ll = (aa.to_bytes(4, byteorder='little') + header + b'\0' + bytes(pdu) +
+          crc.to_bytes(3, byteorder='little'))
+    sniffer_hdr = SnifferPacket.HEADER_STRUCT.pack(SnifferPacket.HEADER_STRUCT.size,
+                                                   flags, channel, rssi,
+                                                   ec & 0xFFFF, tdiff)
+    return build_uart_frame(UartPacketIds.EVENT_PACKET, sniffer_hdr + ll, pc)
+
+def synthetic_frames(count, pdu_sizes=(6, 12, 37), escape_density=0.0,
+                     ping_every=0, seed=0):
+    """Yields count raw UART frames: advertising EVENT_PACKETs with PDUs
+    drawn from pdu_sizes, and a PING_RESP every ping_every frames.
+    escape_density is the chance each PDU byte is one that SLIP has to
+    escape."""
+    rnd = random.Random(seed)
+    for pc in range(count):
+        if ping_every and pc % ping_every == ping_every - 1:
+            yield build_uart_frame(UartPacketIds.PING_RESP, FIRMWARE_VERSION, pc)
+            continue
+        size = rnd.choice(pdu_sizes)
+        pdu = bytes(rnd.choice(SLIP_SPECIALS) if rnd.random() < escape_density
+                    else rnd.randrange(256) for _ in range(size))
+        yield build_event_packet(pc=pc, pdu=pdu, channel=37 + pc % 3,
+                                 rssi=rnd.randrange(30, 95), ec=pc,
+                                 tdiff=rnd.randrange(150, 10000))
+
+def synthetic_stream(count, **kwargs):
+    """SLIP encoded byte stream of synthetic_frames(count, **kwargs)."""
+    encode = SlipPacket.encode
+    return b''.join(encode(frame) for frame in synthetic_frames(count, **kwargs))
+
+def capture_stream(path):
+    """Re-encodes the packets of a pcapng capture as the sniffer would
+    have sent them, for replaying through the decode path."""
+    from .pcapng import PcapngReader
+    encode = SlipPacket.encode
+    with PcapngReader(path) as capture:
+        return b''.join(encode(pkt.data) for pkt in capture)
+
+
+class _Feeder(ABC):
+    """Meters a byte stream out in chunk_size pieces at byte_rate bytes
+    per second (or as fast as the reactor allows if byte_rate is None).
+    While the other end isn't taking anything, it retries every
+    STALL_DELAY seconds rather than spinning."""
+
+    TICK = 0.001
+    STALL_DELAY = 0.01
+
+    def __init__(self, source, byte_rate, chunk_size, loop, clock):
+        self._source = source
+        self._byte_rate = byte_rate
+        self._chunk_size = chunk_size
+        self._loop = loop
+        self._clock = clock
+        self._pos = 0
+        self._credit = 0.0
+        self._last = None
+        self._call = None
+        self._paused = False
+        self.bytes_sent = 0
+        self.done = defer.Deferred()
+
+    def start(self):
+        self._last = self._clock.seconds()
+        self._schedule(0)
+
+    def pause(self):
+        self._paused = True
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def resume(self):
+        if self._paused:
+            self._paused = False
+            self._last = self._clock.seconds()
+            self._schedule(0)
+
+    def stop(self):
+        self.pause()
+        if not self.done.called:
+            self.done.callback(self.bytes_sent)
+
+    def _schedule(self, delay):
+        if self._call is None and not self._paused:
+            self._call = self._clock.callLater(delay, self._tick)
+
+    def _tick(self):
+        self._call = None
+        now = self._clock.seconds()
+        if self._byte_rate is None:
+            budget = self._chunk_size * 64
+        else:
+            self._credit = min(self._credit + (now - self._last) * self._byte_rate,
+                               max(self._byte_rate * 0.1, self._chunk_size))
+            budget = int(self._credit)
+        self._last = now
+
+        sent = 0
+        stalled = False
+        while sent + self._chunk_size <= budget or (sent == 0 and budget >= self._chunk_size):
+            chunk = self._next_chunk()
+            if not chunk:
+                self.stop()
+                return
+            accepted = self._emit(chunk)
+            sent += accepted
+            if accepted < len(chunk):
+                # The other end is full; pick up from here next tick
+                self._pos -= len(chunk) - accepted
+                stalled = accepted == 0
+                break
+            if self._paused:
+                break
+        if self._byte_rate is not None:
+            self._credit -= sent
+        if stalled:
+            self._schedule(self.STALL_DELAY)
+        else:
+            self._schedule(0 if self._byte_rate is None else self.TICK)
+
+    def _next_chunk(self):
+        source = self._source
+        if self._pos >= len(source):
+            if not self._loop or len(source) == 0:
+                return b''
+            self._pos = 0
+        chunk = source[self._pos:self._pos + self._chunk_size]
+        self._pos += len(chunk)
+        return chunk
+
+    @abstractmethod
+    def _emit(self, chunk):
+        """Delivers a chunk; returns how many bytes were taken."""
+
+
+@implementer(ITransport, IPushProducer)
+class SimulatedSniffer(_Feeder):
+    """Stands in for the SerialPort to a real sniffer, playing a SLIP
+    stream (see synthetic_stream() and capture_stream()) into the
+    protocol's dataReceived.  Pass it to NordicSniffer with the stream
+    bound in, e.g.
+
+        transport=functools.partial(SimulatedSniffer, source=stream,
+                                    byte_rate=100000, chunk_size=64)
+
+    byte_rate=None plays the stream as fast as the protocol can take it.
+    Data the protocol writes back is kept in .written.
+
+    Requests written to it are answered like the firmware would:
+    PING_REQ with a PING_RESP, and SWITCH_BAUD_RATE_REQ with a
+    SWITCH_BAUD_RATE_RESP carrying the requested rate if it's one of
+    firmware_rates (the current one otherwise), after which the
+    simulated firmware runs at that rate.  Whenever the host side's
+    baudrate doesn't match the firmware's nothing gets through; the
+    bytes lost are counted in bytes_garbled.  Answers carry the packet
+    counter after the last one played, so the stream's own next packet
+    repeats it (which PacketBuffer counts as a seq_reset, not loss)."""
+
+    def __init__(self, protocol, port=None, clock=reactor, baudrate=460800,
+                 source=b'', byte_rate=None, chunk_size=256, loop=False,
+                 firmware_rates=(1000000, 460800)):
+        super().__init__(bytes(source), byte_rate, chunk_size, loop, clock)
+        self.protocol = protocol
+        self.port = port
+        self.baudrate = baudrate
+        self.firmware_baudrate = baudrate
+        self.firmware_rates = firmware_rates
+        self.written = bytearray()
+        self.requests = []
+        self.bytes_garbled = 0
+        self._rx = SlipDecoder()
+        self._replies = []
+        self._mid_frame = False
+        self._played = 0
+        self.connected = True
+        protocol.makeConnection(self)
+        self.start()
+
+    def _emit(self, chunk):
+        size = len(chunk)
+        start = self._pos - size
+        self.bytes_sent += size
+        rate = self.firmware_baudrate
+        if self._replies and self._mid_frame:
+            # Answers go out between frames, like the firmware's would
+            end = chunk.find(SlipPacket.SLIP_END)
+            if end >= 0:
+                self._deliver(chunk[:end + 1], rate)
+                self._played = start + end + 1
+                self._mid_frame = False
+                self._flush_replies()
+                chunk = chunk[end + 1:]
+        self._deliver(chunk, rate)
+        self._played = self._pos
+        last_start = chunk.rfind(SlipPacket.SLIP_START)
+        last_end = chunk.rfind(SlipPacket.SLIP_END)
+        if last_start != last_end:
+            self._mid_frame = last_start > last_end
+        self._flush_replies()
+        return size
+
+    def _deliver(self, data, rate):
+        if not self.connected:
+            return
+        if rate != self.baudrate:
+            self.bytes_garbled += len(data)
+            return
+        self.protocol.dataReceived(data)
+
+    def _next_pc(self):
+        # Counter of the last frame played, plus one
+        source = self._source
+        end = source.rfind(SlipPacket.SLIP_END, 0, self._played)
+        start = source.rfind(SlipPacket.SLIP_START, 0, max(end, 0))
+        if start < 0:
+            return 0
+        frame = SlipDecoder().feed(source[start:end + 1])
+        if not frame or len(frame[0]) < UartPacket.HEADER_STRUCT.size:
+            return 0
+        return (UartPacket.HEADER_STRUCT.unpack_from(frame[0])[3] + 1) & 0xFFFF
+
+    def _reply(self, pkt_id, payload):
+        self._replies.append((pkt_id, payload, self.firmware_baudrate))
+        self._clock.callLater(0, self._flush_replies)
+
+    def _flush_replies(self):
+        if self._mid_frame:
+            return
+        replies, self._replies = self._replies, []
+        for pkt_id, payload, rate in replies:
+            frame = build_uart_frame(pkt_id, payload, self._next_pc())
+            self._deliver(SlipPacket.encode(frame), rate)
+
+    def _handle_request(self, frame):
+        if self.baudrate != self.firmware_baudrate:
+            return
+        try:
+            pkt = UartPacket(frame)
+        except (ValueError, IndexError):
+            return
+        self.requests.append(pkt)
+        if pkt.id == UartPacketIds.PING_REQ:
+            self._reply(UartPacketIds.PING_RESP, FIRMWARE_VERSION)
+        elif pkt.id == UartPacketIds.SWITCH_BAUD_RATE_REQ:
+            rate = int.from_bytes(bytes(pkt.payload[:4]), byteorder='little')
+            if rate not in self.firmware_rates:
+                rate = self.firmware_baudrate
+            self._reply(UartPacketIds.SWITCH_BAUD_RATE_RESP,
+                        rate.to_bytes(4, byteorder='little'))
+            self.firmware_baudrate = rate
+
+    # ITransport
+    def write(self, data):
+        self.written.extend(data)
+        for frame in self._rx.feed(data):
+            self._handle_request(frame)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def loseConnection(self):
+        if self.connected:
+            self.connected = False
+            self.stop()
+            self.protocol.connectionLost(None)
+
+    def getPeer(self):
+        return self.port
+
+    def getHost(self):
+        return self.port
+
+    def setBaudRate(self, baudrate):
+        self.baudrate = baudrate
+
+    # IPushProducer
+    def pauseProducing(self):
+        self.pause()
+
+    def resumeProducing(self):
+        self.resume()
+
+    def stopProducing(self):
+        self.loseConnection()
+
+
+class PtySniffer(_Feeder):
+    """Plays a SLIP stream into the master side of a pty pair so the real
+    SerialPort path can be exercised; open .port with NordicSniffer as if
+    it were the sniffer's tty."""
+
+    def __init__(self, source=b'', byte_rate=None, chunk_size=256, loop=False,
+                 clock=reactor):
+        super().__init__(bytes(source), byte_rate, chunk_size, loop, clock)
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+
+    def _emit(self, chunk):
+        try:
+            sent = os.write(self._master, chunk)
+        except BlockingIOError:
+            return 0
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise
+            # Nothing has the slave side open
+            return 0
+        self.bytes_sent += sent
+        return sent
+
+    def close(self):
+        self.stop()
+        os.close(self._master)
+        os.close(self._slave)
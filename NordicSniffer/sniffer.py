@@ -1,24 +1,98 @@
-from twisted.internet import reactor, task
+from twisted.internet import defer, error, reactor, task
 from twisted.internet.serialport import SerialPort
 from twisted.protocols import basic
 from twisted.logger import Logger
-from .packets import SnifferPacket, BleLinkLayerPacket, SlipPacket, UartPacket
+from .packets import SnifferPacket, BleLinkLayerPacket, SlipPacket, UartPacket, UartPacketIds
 from .PacketBuffer import *
+from .stream import PacketStream
 
 log = Logger(namespace="NordicSniffer")
 
+# UART rates the sniffer firmware can switch to, fastest first
+SNIFFER_BAUD_RATES = (1000000, 460800)
+
+# What the firmware answers each request with; the other requests get
+# no answer
+RESPONSE_IDS = {
+    UartPacketIds.PING_REQ: UartPacketIds.PING_RESP,
+    UartPacketIds.SWITCH_BAUD_RATE_REQ: UartPacketIds.SWITCH_BAUD_RATE_RESP,
+}
+
+class _ResponseWaiter:
+    """Sink that hands the next packet with a given ID to whoever is
+    waiting for it.  Several can wait on the same ID; the firmware
+    answers in order, so they're matched up first come first served."""
+
+    def __init__(self, clock=reactor):
+        self._clock = clock
+        self._waiting = {}
+
+    def expect(self, pkt_id, timeout):
+        """Deferred firing with the next packet of type pkt_id, or
+        failing with defer.TimeoutError after timeout seconds."""
+        d = defer.Deferred()
+        waiters = self._waiting.setdefault(pkt_id, [])
+        waiters.append(d)
+
+        def forget(result):
+            if d in waiters:
+                waiters.remove(d)
+            return result
+        d.addTimeout(timeout, self._clock)
+        d.addBoth(forget)
+        return d
+
+    @property
+    def pending(self):
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    def fail_all(self, failure):
+        waiting, self._waiting = self._waiting, {}
+        for waiters in waiting.values():
+            for d in list(waiters):
+                d.errback(failure)
+
+    def write_packets(self, packets):
+        if not self._waiting:
+            return
+        for pkt in packets:
+            waiters = self._waiting.get(pkt.id)
+            if waiters:
+                waiters.pop(0).callback(pkt)
+
 class NordicSniffer(basic.LineReceiver):
     # Default port is USB0, add detect and reconnect?  Twisted
     # may handle that.
-    def __init__(self, port="/dev/ttyUSB0", baud=460800, callback=None):
+    #
+    # transport is called like SerialPort(protocol, port, reactor,
+    # baudrate=...) to open the link; pass something from
+    # NordicSniffer.simulator to run without the hardware.
+    #
+    # The link stays at baud unless baud_rates is given (e.g.
+    # SNIFFER_BAUD_RATES), in which case the fastest of them that the
+    # firmware and the host UART agree on is negotiated once connected,
+    # which sends the firmware SWITCH_BAUD_RATE_REQs (see
+    # negotiate_baud()).  .negotiated fires with the rate settled on.
+    def __init__(self, port="/dev/ttyUSB0", baud=460800, callback=None,
+                 transport=SerialPort, pbuf=None, baud_rates=None,
+                 response_timeout=1.0):
         self.setRawMode()
-        self._seq_id = None
         self._serial_buffer = bytearray()
         self._packet_buffer = []
-        self._pbuf = PacketBuffer()
+        self._pbuf = PacketBuffer() if pbuf is None else pbuf
+        self._responses = _ResponseWaiter()
+        self._pbuf.subscribe(self._responses)
+        self._tx_count = 0
+        self._tx_queue = []
+        self._tx_call = None
+        self.frames_sent = 0
+        self.writes = 0
+        self._baud_rates = baud_rates
+        self.response_timeout = response_timeout
+        self.negotiated = defer.Deferred()
         self.port = port
-        self.baud = baud
-        SerialPort(self, self.port, reactor, baudrate=460800)
+        self._baud = baud
+        transport(self, self.port, reactor, baudrate=baud)
 
     def __repr__(self):
         return "NordicSniffer({})".format(self._port)
@@ -30,21 +104,163 @@ class NordicSniffer(basic.LineReceiver):
     def stop(self):
         reactor.stop()
 
-    # TODO - implement as Twisted deferred? (so it can catch the reply)
-    def send_ping(self):
-        self._log.debug("ping!")
-        pass
+    def send_ping(self, timeout=None):
+        """Deferred firing with the firmware version from the PING_RESP."""
+        log.debug("ping!")
+        d = self.request(UartPacketIds.PING_REQ, timeout=timeout)
+        d.addCallback(lambda resp: bytes(resp.payload))
+        return d
 
     def send_pkt(self, packet):
-        pass
+        """Numbers packet, SLIP encodes it and queues it for the sniffer.
+        Everything sent in one pass of the reactor goes out in a single
+        write."""
+        packet.pc = self._tx_count
+        self._tx_count = (self._tx_count + 1) & 0xFFFF
+        self._tx_queue.append(SlipPacket.encode(packet.as_bytearray))
+        self.frames_sent += 1
+        if self._tx_call is None:
+            self._tx_call = reactor.callLater(0, self.flush)
+        return packet
 
-    def scan(self):
+    def flush(self):
+        """Writes out whatever send_pkt() has queued."""
+        if self._tx_call is not None and self._tx_call.active():
+            self._tx_call.cancel()
+        self._tx_call = None
+        if not self._tx_queue or self.transport is None:
+            return
+        data, self._tx_queue = b''.join(self._tx_queue), []
+        self.transport.write(data)
+        self.writes += 1
+
+    def request(self, pkt_id, payload=b'', timeout=None):
+        """Sends a request to the sniffer.  Returns a Deferred firing
+        with the matching response packet (see RESPONSE_IDS), failing
+        with defer.TimeoutError if none arrives within timeout seconds;
+        requests the firmware doesn't answer fire with None straight
+        away.  Any number can be in flight at once."""
         pkt = UartPacket()
-        pkt.id = UartPacketIds.REQ_SCAN_CONT
-        pkt.payload = []
-        self._log.debug("SCAN!")
-        reactor.callFromThread(self.send_ping)
-        pass
+        pkt.id = pkt_id
+        pkt.payload = bytearray(payload)
+        resp_id = RESPONSE_IDS.get(pkt.id)
+        d = defer.succeed(None) if resp_id is None else self.expect(resp_id, timeout)
+        self.send_pkt(pkt)
+        return d
+
+    def expect(self, pkt_id, timeout=None):
+        """Deferred firing with the next packet of type pkt_id to arrive."""
+        if timeout is None:
+            timeout = self.response_timeout
+        return self._responses.expect(UartPacketIds(pkt_id), timeout)
+
+    def _host_supports(self, rate):
+        """Whether the host UART should manage rate, going by pyserial's
+        list of standard rates; the port isn't touched.  Transports
+        without a list are taken to do any rate."""
+        serial = getattr(self.transport, '_serial', self.transport)
+        rates = getattr(serial, 'BAUDRATES', None)
+        return rates is None or rate in rates
+
+    def _set_host_baud(self, rate):
+        """Switches the host UART; False if it won't do that rate."""
+        serial = getattr(self.transport, '_serial', None)
+        try:
+            if serial is not None:
+                # SerialPort.setBaudRate() still calls the pyserial 2 API
+                serial.baudrate = rate
+            else:
+                self.transport.setBaudRate(rate)
+        except (ValueError, OSError) as e:
+            log.debug("host UART can't do {rate} baud: {err}", rate=rate, err=e)
+            return False
+        return True
+
+    @defer.inlineCallbacks
+    def _ping_at(self, rate, attempts=2):
+        """True once a ping gets answered, after up to attempts tries"""
+        for attempt in range(attempts):
+            try:
+                yield self.send_ping()
+            except defer.TimeoutError:
+                log.debug("no answer to ping {n} at {rate} baud", n=attempt + 1, rate=rate)
+                continue
+            return True
+        return False
+
+    @defer.inlineCallbacks
+    def negotiate_baud(self, rates=None):
+        """Asks the firmware for each rate faster than the current one,
+        fastest first, until one works at both ends.  A rate is only
+        asked for if the host UART supports it; after the firmware
+        confirms with SWITCH_BAUD_RATE_RESP the host follows and the link
+        is checked with a ping.  If that gets no answer the firmware is
+        asked, at the new rate, to go back to the old one, and the host
+        follows it there.  Fires with the rate in use."""
+        rates = self._baud_rates if rates is None else rates
+        current = self._baud
+        for rate in sorted(set(rates or ()), reverse=True):
+            if rate <= current:
+                break
+            if not self._host_supports(rate):
+                log.debug("host UART doesn't list {rate} baud", rate=rate)
+                continue
+            try:
+                resp = yield self.request(UartPacketIds.SWITCH_BAUD_RATE_REQ,
+                                          rate.to_bytes(4, byteorder='little'))
+            except defer.TimeoutError:
+                log.info("no answer to a switch to {rate} baud", rate=rate)
+                break
+            payload = bytes(resp.payload)
+            new_rate = int.from_bytes(payload[:4], byteorder='little') if len(payload) >= 4 else rate
+            if new_rate == current:
+                # Firmware turned it down
+                continue
+            if not self._set_host_baud(new_rate):
+                log.error("firmware moved to {rate} baud, which the host can't follow",
+                          rate=new_rate)
+                break
+            self._baud = new_rate
+            alive = yield self._ping_at(new_rate)
+            if alive:
+                log.info("switched to {rate} baud", rate=new_rate)
+                break
+            # The firmware only listens at its own rate, so the way back
+            # has to be asked for from here
+            log.warn("link dead at {rate} baud; asking to go back to {old}",
+                     rate=new_rate, old=current)
+            back = self.request(UartPacketIds.SWITCH_BAUD_RATE_REQ,
+                                current.to_bytes(4, byteorder='little'))
+            self.flush()
+            try:
+                yield back
+            except defer.TimeoutError:
+                pass
+            self._set_host_baud(current)
+            self._baud = current
+            self._pbuf.decoder.reset()
+            alive = yield self._ping_at(current)
+            if not alive:
+                log.error("no answer at {old} baud either", old=current)
+            break
+        return self._baud
+
+    def scan(self):
+        """Puts the sniffer (back) into scanning for advertisers."""
+        log.debug("SCAN!")
+        return self.request(UartPacketIds.REQ_SCAN_CONT)
+
+    def follow(self, address, random_address=False, adv_only=False):
+        """Has the sniffer follow the advertiser at address ('AA:BB:...'
+        or 6 bytes as sent over the air) into its next connection; see
+        connections.ConnectionTracker for keeping track of it."""
+        if isinstance(address, str):
+            address = bytes.fromhex(address.replace(':', ''))[::-1]
+        if len(address) != 6:
+            raise ValueError("BLE addresses are 6 bytes")
+        log.debug("following {addr}", addr=bytes(address[::-1]).hex(':'))
+        payload = bytes(address) + bytes((int(random_address), int(adv_only)))
+        return self.request(UartPacketIds.REQ_FOLLOW, payload)
 
     @property
     def baud(self):
@@ -52,7 +268,10 @@ class NordicSniffer(basic.LineReceiver):
 
     @baud.setter
     def baud(self, rate):
-        # TODO: this should re-init the link and can fail.
+        """Switches rate; see negotiate_baud() for doing it with the
+        firmware's agreement."""
+        if self.transport is not None and not self._set_host_baud(rate):
+            raise ValueError("can't switch to {} baud".format(rate))
         self._baud = rate
 
     @property
@@ -74,80 +293,56 @@ class NordicSniffer(basic.LineReceiver):
 
     @property
     def seq_id(self):
-        return self._seq_id
-
-    # TODO - jbradach - 2016/10/11 - something is making some the UART packets
-    # TODO - sequencing incorrect.  Make sure it's the firmware not sending vs
-    # TODO - the API dropping them somewhere.
-    @seq_id.setter
-    def seq_id(self, new_seq_id):
-        log = self._log
-        if self.seq_id is not None:
-            if new_seq_id != (self.seq_id + 1):
-                exp_seq = self.seq_id + 1
-                log.debug("Dropped packet(s) #{}-{}".format(exp_seq, new_seq_id-1))
-        self._seq_id = new_seq_id
+        """packet counter of the latest packet from the sniffer"""
+        return self._pbuf.seq_id
+
+    @property
+    def packets_lost(self):
+        """packets missing from the sniffer's packet counter sequence;
+        see PacketBuffer"""
+        return self._pbuf.packets_lost
 
     @property
     def pbuf(self):
         return self._pbuf
 
+    def add_sink(self, sink):
+        """sink.write_packet(pkt) gets called for every decoded packet"""
+        self._pbuf.subscribe(sink)
+
+    def remove_sink(self, sink):
+        self._pbuf.unsubscribe(sink)
+
+    def packets(self, max_pending=65536, loop=None):
+        """Returns a PacketStream of the packets decoded from here on,
+        for use with async for / await stream.batch(); close() it to
+        unsubscribe."""
+        stream = PacketStream(max_pending=max_pending, on_close=self.remove_sink,
+                              loop=loop)
+        self.add_sink(stream)
+        return stream
+
     # Callbacks for Twisted
+    def connectionMade(self):
+        self._pbuf.attach(self.transport)
+        d = self.negotiate_baud()
+        d.addErrback(self._negotiation_failed)
+        d.chainDeferred(self.negotiated)
+
+    def _negotiation_failed(self, failure):
+        log.failure("baud negotiation failed", failure)
+        return self._baud
+
     def connected(self):
         print("Connected to sniffer")
 
     def connectionLost(self, reason):
         print("Sniffer connection lost")
+        if self._tx_call is not None and self._tx_call.active():
+            self._tx_call.cancel()
+        self._tx_call = None
+        self._tx_queue = []
+        self._responses.fail_all(error.ConnectionLost() if reason is None else reason)
 
     def rawDataReceived(self, recv_data):
         new_pkt_count = self._pbuf.add(recv_data)
-
-class PacketBuffer():
-    in_buf = bytearray()
-    out_buf = []
-    buffer_limit = 0
-
-    def __init__(self, buffer_limit=65536):
-        self.buffer_limit = buffer_limit
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if len(self.out_buf) == 0:
-            raise StopIteration
-        pkt = self.out_buf.pop(0)
-        return pkt
-
-    def add(self, rcvd_data):
-        pbuf = self.in_buf
-        pbuf.extend(bytearray(rcvd_data))
-        headroom = self.buffer_limit - len(pbuf)
-        if headroom < 0:
-            print("in_buf exceeds limit by {:d} bytes, trimming".format(-headroom))
-            del pbuf[:-headroom]
-        pkt_cnt = self._process_in_buf()
-
-        return pkt_cnt
-
-    def size(self):
-        return out_buf.size()
-
-    def get(self):
-        packet = None
-        if len(self.out_buf) > 0:
-            packet = self.out_buf.pop()
-        return packet
-
-    def _process_in_buf(self):
-        """Uses the SlipPacket class to extract packets from the
-        in_buffer.  These will then be converted into UartPackets
-        and stored in the out_buffer."""
-        packets = SlipPacket.find(self.in_buf)
-        uart_pkts = []
-        for pkt in packets:
-            uart_pkt = UartPacket(pkt.data)
-            uart_pkts.append(uart_pkt)
-
-        self.out_buf.extend(uart_pkts)
-        return len(uart_pkts)
@@ -0,0 +1,226 @@
+import struct
+import numpy as np
+from .packets import BleLinkLayerPacket, SnifferPacket, UartPacket, UartPacketIds
+
+ADV_ACCESS_ADDRESS = 0x8E89BED6
+
+# One record per sniffed BLE packet
+CAPTURE_DTYPE = np.dtype([
+    ('timestamp', '<u8'),
+    ('channel', 'u1'),
+    ('rssi', '<i2'),
+    ('ec', '<u2'),
+    ('tdiff', '<u4'),
+    ('crc_ok', '?'),
+    ('dir', '?'),
+    ('encrypted', '?'),
+    ('mic_ok', '?'),
+    ('aa', '<u4'),
+    ('pdu_len', 'u1'),
+])
+
+class CaptureStore:
+    """Columnar store for the sniffer header fields of a capture.
+
+    Every EVENT_PACKET appended becomes one row of a growable NumPy
+    structured array (see CAPTURE_DTYPE); the link layer bytes go into a
+    single contiguous arena, with offsets[i]:offsets[i+1] marking packet
+    i.  Per-channel statistics and the like then become vectorized
+    queries over the columns.  Other UART packets are ignored, so the
+    store can be subscribed to a sniffer as a sink."""
+
+    def __init__(self, capacity=4096, arena_capacity=None):
+        if arena_capacity is None:
+            arena_capacity = capacity * 64
+        self._records = np.zeros(capacity, dtype=CAPTURE_DTYPE)
+        self._offsets = np.zeros(capacity + 1, dtype=np.uint64)
+        self._arena = np.zeros(arena_capacity, dtype=np.uint8)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, item):
+        return self.records[item]
+
+    @property
+    def records(self):
+        """structured array of every row stored so far"""
+        return self._records[:self._len]
+
+    @property
+    def offsets(self):
+        """start of each packet's bytes in the arena, plus the end"""
+        return self._offsets[:self._len + 1]
+
+    @property
+    def arena(self):
+        return self._arena[:int(self._offsets[self._len])]
+
+    def column(self, name):
+        return self._records[name][:self._len]
+
+    def payload(self, index):
+        """link layer bytes (AA through CRC) of a stored packet"""
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("capture store index out of range")
+        start, end = self._offsets[index:index+2]
+        return memoryview(self._arena)[int(start):int(end)]
+
+    def append(self, packet):
+        return self.extend((packet,)) == 1
+
+    def extend(self, packets):
+        """Adds a batch of UartPackets or SnifferPackets; returns how many
+        were stored."""
+        sniffer_hdr = SnifferPacket.HEADER_STRUCT
+        ll_hdr = BleLinkLayerPacket.HEADER_STRUCT
+        rows = []
+        payloads = []
+        for pkt in packets:
+            if isinstance(pkt, UartPacket):
+                if pkt.id != UartPacketIds.EVENT_PACKET:
+                    continue
+                data = pkt.payload
+            else:
+                data = memoryview(pkt.data)
+            try:
+                hlen, flags, channel, rssi, ec, tdiff = sniffer_hdr.unpack_from(data)
+            except struct.error:
+                continue
+            ll = data[hlen:]
+            try:
+                aa, _, pdu_len = ll_hdr.unpack_from(ll)
+            except struct.error:
+                aa, pdu_len = 0, 0
+            rows.append((pkt.timestamp or 0, channel, -rssi, ec, tdiff,
+                         flags & 0x1, flags & 0x2, flags & 0x4, flags & 0x8,
+                         aa, pdu_len))
+            payloads.append(ll)
+
+        count = len(rows)
+        if count == 0:
+            return 0
+        blob = b''.join(payloads)
+        self._reserve(count, len(blob))
+
+        start = self._len
+        end = start + count
+        self._records[start:end] = np.array(rows, dtype=CAPTURE_DTYPE)
+        lengths = np.fromiter((len(p) for p in payloads), dtype=np.uint64, count=count)
+        base = self._offsets[start]
+        np.cumsum(lengths, out=self._offsets[start+1:end+1])
+        self._offsets[start+1:end+1] += base
+        self._arena[int(base):int(base) + len(blob)] = np.frombuffer(blob, dtype=np.uint8)
+        self._len = end
+        return count
+
+    # Sink interface, so a store can be handed to NordicSniffer.add_sink()
+    def write_packet(self, packet):
+        self.append(packet)
+
+    def write_packets(self, packets):
+        self.extend(packets)
+
+    def _reserve(self, rows, arena_bytes):
+        needed = self._len + rows
+        capacity = len(self._records)
+        if needed > capacity:
+            while capacity < needed:
+                capacity *= 2
+            records = np.zeros(capacity, dtype=CAPTURE_DTYPE)
+            records[:self._len] = self._records[:self._len]
+            self._records = records
+            offsets = np.zeros(capacity + 1, dtype=np.uint64)
+            offsets[:self._len + 1] = self._offsets[:self._len + 1]
+            self._offsets = offsets
+
+        used = int(self._offsets[self._len])
+        needed = used + arena_bytes
+        capacity = len(self._arena)
+        if needed > capacity:
+            while capacity < needed:
+                capacity *= 2
+            arena = np.zeros(capacity, dtype=np.uint8)
+            arena[:used] = self._arena[:used]
+            self._arena = arena
+
+    # Canned queries
+    def channel_stats(self):
+        """Per-channel packet count, RSSI (mean/min/max) and CRC error
+        rate, as a dict keyed on channel number."""
+        records = self.records
+        channels = records['channel']
+        rssi = records['rssi'].astype(np.int64)
+        counts = np.bincount(channels, minlength=40)
+        rssi_sum = np.bincount(channels, weights=rssi, minlength=40)
+        crc_err = np.bincount(channels, weights=~records['crc_ok'], minlength=40)
+        rssi_min = np.full(len(counts), np.iinfo(np.int64).max)
+        rssi_max = np.full(len(counts), np.iinfo(np.int64).min)
+        np.minimum.at(rssi_min, channels, rssi)
+        np.maximum.at(rssi_max, channels, rssi)
+
+        stats = {}
+        for channel in np.flatnonzero(counts):
+            n = int(counts[channel])
+            stats[int(channel)] = {
+                'count': n,
+                'rssi_mean': float(rssi_sum[channel] / n),
+                'rssi_min': int(rssi_min[channel]),
+                'rssi_max': int(rssi_max[channel]),
+                'crc_error_rate': float(crc_err[channel] / n),
+            }
+        return stats
+
+    def loss_stats(self, include_advertising=False):
+        """Per access address loss, from gaps in the event counter: a
+        dict keyed on aa of packet count, connection events seen, events
+        missed and the loss rate (missed / (seen + missed)).  Advertising
+        packets are left out unless include_advertising is set, as their
+        event counter means nothing."""
+        records = self.records
+        aa = records['aa']
+        ec = records['ec'].astype(np.int64)
+        if not include_advertising:
+            keep = aa != ADV_ACCESS_ADDRESS
+            aa, ec = aa[keep], ec[keep]
+        if len(aa) == 0:
+            return {}
+        # Group by address, keeping capture order within each
+        order = np.argsort(aa, kind='stable')
+        aa, ec = aa[order], ec[order]
+        same = aa[1:] == aa[:-1]
+        step = (ec[1:] - ec[:-1]) % 0x10000
+        # Several packets in one event step by 0, anything past 1 is
+        # missed; a jump backwards is a new connection, not loss
+        new_event = same & (step != 0)
+        missed = np.where(same & (step > 1) & (step < 0x8000), step - 1, 0)
+
+        starts = np.flatnonzero(np.concatenate(([True], ~same)))
+        packets = np.diff(np.append(starts, len(aa)))
+        # Per-group sums of the pairwise values (pair i lines up with row
+        # i+1); each group's first packet starts an event of its own
+        events = np.add.reduceat(np.concatenate(([0], new_event)).astype(np.int64), starts) + 1
+        lost = np.add.reduceat(np.concatenate(([0], missed)), starts)
+
+        stats = {}
+        for i, start in enumerate(starts):
+            seen, gone = int(events[i]), int(lost[i])
+            stats[int(aa[start])] = {
+                'packets': int(packets[i]),
+                'events': seen,
+                'missed_events': gone,
+                'loss_rate': gone / (seen + gone),
+            }
+        return stats
+
+    def select(self, **fields):
+        """Indices of the rows matching every field == value given,
+        e.g. store.select(channel=37, aa=0x8e89bed6)."""
+        records = self.records
+        mask = np.ones(len(records), dtype=bool)
+        for name, value in fields.items():
+            mask &= records[name] == value
+        return np.flatnonzero(mask)
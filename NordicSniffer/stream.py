@@ -0,0 +1,141 @@
+import asyncio
+from collections import deque
+from twisted.internet import defer, reactor
+
+class PacketStream:
+    """Asynchronous iterator over decoded packets.
+
+    Subscribed to a sniffer as a sink (see NordicSniffer.packets()), it
+    queues up to max_pending packets (dropping the oldest beyond that,
+    counted in dropped) and wakes a waiting consumer as soon as a frame
+    is decoded:
+
+        async for pkt in sniffer.packets():
+            ...
+
+        pkts = await stream.batch(32, timeout=0.05)
+
+    Works from asyncio tasks and from Twisted coroutines (ensureDeferred /
+    inlineCallbacks); pass loop to force the asyncio flavour."""
+
+    def __init__(self, max_pending=65536, on_close=None, loop=None, clock=reactor):
+        self._queue = deque()
+        self._max_pending = max_pending
+        self._on_close = on_close
+        self._loop = loop
+        self._clock = clock
+        self._waiter = None
+        self._want = 1
+        self._timer = None
+        self._closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            if self._closed:
+                raise StopAsyncIteration
+            try:
+                await self._wait(1, None)
+            finally:
+                self._clear_wait()
+        return self._queue.popleft()
+
+    async def batch(self, count, timeout=None):
+        """Waits for count packets or timeout seconds, whichever comes
+        first, and returns what's there (possibly nothing, on timeout)."""
+        if len(self._queue) < count and not self._closed:
+            try:
+                await self._wait(count, timeout)
+            finally:
+                self._clear_wait()
+        queue = self._queue
+        return [queue.popleft() for _ in range(min(count, len(queue)))]
+
+    def close(self):
+        """Stops the stream; consumers see the end of iteration once the
+        queued packets are used up."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._on_close is not None:
+            self._on_close(self)
+        self._wake()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    # Sink interface
+    def write_packet(self, packet):
+        self.write_packets((packet,))
+
+    def write_packets(self, packets):
+        if self._closed:
+            return
+        queue = self._queue
+        queue.extend(packets)
+        overage = len(queue) - self._max_pending
+        if overage > 0:
+            for _ in range(overage):
+                queue.popleft()
+            self.dropped += overage
+        if self._waiter is not None and len(queue) >= self._want:
+            self._wake()
+
+    def _wait(self, count, timeout):
+        if self._waiter is not None:
+            raise RuntimeError("PacketStream already has a consumer waiting")
+        loop = self._asyncio_loop()
+        d = self._waiter = defer.Deferred(self._cancel_wait)
+        self._want = count
+        if timeout is not None:
+            if loop is not None:
+                self._timer = loop.call_later(timeout, self._wake)
+            else:
+                self._timer = self._clock.callLater(timeout, self._wake)
+        return d if loop is None else d.asFuture(loop)
+
+    def _asyncio_loop(self):
+        """The asyncio loop to wait on, or None to wait Twisted style"""
+        loop = self._loop
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return None
+            if asyncio.current_task(loop) is None:
+                # A Twisted coroutine on the asyncio reactor
+                return None
+        return loop
+
+    def _cancel_timer(self):
+        timer, self._timer = self._timer, None
+        if timer is None:
+            return
+        # asyncio handles have no active(); cancelling them twice is fine
+        active = getattr(timer, 'active', None)
+        if active is None or active():
+            timer.cancel()
+
+    def _cancel_wait(self, d):
+        # The consumer's await was cancelled (asyncio.wait_for() timing
+        # out, say); leave the stream ready for the next one
+        if self._waiter is d:
+            self._waiter = None
+        self._cancel_timer()
+
+    def _clear_wait(self):
+        self._waiter = None
+        self._cancel_timer()
+
+    def _wake(self):
+        self._cancel_timer()
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter.callback(None)
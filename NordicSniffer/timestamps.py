@@ -0,0 +1,118 @@
+import time
+from struct import Struct
+from .packets import SnifferPacket, UartPacket, UartPacketIds
+
+# Where the sniffer header's tdiff and the link layer length byte sit in
+# an EVENT_PACKET frame with the default header lengths
+_TDIFF = Struct("<I")
+_TDIFF_OFFSET = UartPacket.HLEN_DEFAULT + 6
+_LL_LEN_OFFSET = UartPacket.HLEN_DEFAULT + SnifferPacket.HEADER_STRUCT.size + 5
+_EVENT_PACKET = int(UartPacketIds.EVENT_PACKET)
+
+# Preamble, access address, header and CRC around the PDU
+LL_AIR_OVERHEAD = 1 + 4 + 2 + 3
+US_PER_BYTE = 8     # LE 1M PHY
+
+class PacketClock:
+    """Microsecond timestamps for decoded frames.
+
+    The host clock is read once per serial chunk, never per packet.
+    Within the stream each EVENT_PACKET is stamped with the previous
+    one's timestamp plus that packet's air time plus the firmware's
+    tdiff (the gap from the end of one packet to the start of the next),
+    so inter-packet timing is as good as the sniffer's own clock.  The
+    chain is anchored by lining the last packet of the first chunk up
+    with the chunk's arrival time.  Other frames get their chunk's
+    arrival time.
+
+    A packet can't have happened after it arrived, so a chain that runs
+    ahead of the host (a fast sniffer clock) is pulled back as soon as
+    it does.  One that falls more than max_lag µs behind (a slow clock,
+    or frames lost on the way) is moved forward at the next of the
+    checks made every resync_interval seconds.  Adjustments are counted
+    in resyncs and corrected_us."""
+
+    def __init__(self, resync_interval=1.0, max_lag=5000,
+                 monotonic=time.monotonic, wall=time.time):
+        self._monotonic = monotonic
+        self._offset = int(wall() * 1e6) - int(monotonic() * 1e6)
+        self.resync_interval = resync_interval
+        self.max_lag = max_lag
+        self._last = None
+        self._airtime = 0
+        self._min_lag = None
+        self._next_sync = None
+        self.resyncs = 0
+        self.corrected_us = 0
+
+    @property
+    def last(self):
+        """timestamp of the latest EVENT_PACKET"""
+        return self._last
+
+    def now(self):
+        """host time in µs since the epoch, from the monotonic clock"""
+        return int(self._monotonic() * 1e6) + self._offset
+
+    def stamp_chunk(self, frames, arrival=None):
+        """Timestamps (µs since the epoch) for the raw frames completed
+        by one serial chunk, which arrived at arrival or now."""
+        if arrival is None:
+            arrival = self.now()
+        if self._next_sync is None:
+            self._next_sync = arrival + int(self.resync_interval * 1e6)
+        elif arrival >= self._next_sync:
+            self._resync()
+            self._next_sync = arrival + int(self.resync_interval * 1e6)
+
+        stamps = []
+        events = []
+        prev = self._last
+        last = 0 if prev is None else prev
+        airtime = self._airtime
+        unpack_tdiff = _TDIFF.unpack_from
+        for frame in frames:
+            if len(frame) <= _LL_LEN_OFFSET or frame[5] != _EVENT_PACKET:
+                stamps.append(arrival)
+                continue
+            if events or prev is not None:
+                last += airtime + unpack_tdiff(frame, _TDIFF_OFFSET)[0]
+            airtime = (frame[_LL_LEN_OFFSET] + LL_AIR_OVERHEAD) * US_PER_BYTE
+            events.append(len(stamps))
+            stamps.append(last)
+        if not events:
+            return stamps
+
+        lag = arrival - last
+        if prev is None:
+            shift = lag
+        elif lag < 0:
+            # Ahead of the host; the sniffer's clock runs fast
+            shift = lag
+            self.resyncs += 1
+            self.corrected_us += lag
+        else:
+            shift = 0
+            if self._min_lag is None or lag < self._min_lag:
+                self._min_lag = lag
+        if shift:
+            floor = None if prev is None else prev
+            for i in events:
+                ts = stamps[i] + shift
+                if floor is not None and ts <= floor:
+                    ts = floor + 1
+                stamps[i] = floor = ts
+            last = stamps[events[-1]]
+        self._last = last
+        self._airtime = airtime
+        return stamps
+
+    def _resync(self):
+        # Every chunk in the last interval arrived at least min_lag after
+        # its last packet; if that's more than max_lag the chain has
+        # fallen behind, so move it forward.
+        min_lag, self._min_lag = self._min_lag, None
+        if min_lag is not None and min_lag > self.max_lag:
+            self._last += min_lag
+            self.resyncs += 1
+            self.corrected_us += min_lag
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""Benchmarks for the bytes -> packets -> pcapng pipeline.
+
+Each stage is timed on its own against reproducible synthetic SLIP
+streams (see NordicSniffer.simulator) covering a few packet sizes and
+escape densities, and then the whole path is timed end to end.
+Results are printed as MB/s of input, packets/s and peak traced memory,
+and can be saved as JSON to compare later runs against:
+
+    python3 benchmarks/bench_pipeline.py --save baseline.json
+    python3 benchmarks/bench_pipeline.py --compare baseline.json
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from NordicSniffer.PacketBuffer import PacketBuffer
+from NordicSniffer.packets import SlipDecoder, SlipPacket, UartPacket
+from NordicSniffer.pcapng import (LINKTYPE_BLUETOOTH_LE_LL, PcapngStreamWriter, Section,
+                                  create_epb, encode_epbs)
+from NordicSniffer.simulator import synthetic_frames
+
+# (name, PDU sizes, escape density)
+PROFILES = [
+    ('small', (6,), 0.0),
+    ('mixed', (6, 12, 37), 0.02),
+    ('large', (37,), 0.0),
+    ('escapes', (6, 12, 37), 0.25),
+]
+
+CHUNK_SIZE = 256
+
+
+class Workload:
+    def __init__(self, name, pdu_sizes, escape_density, count):
+        self.name = name
+        self.frames = list(synthetic_frames(count, pdu_sizes=pdu_sizes,
+                                            escape_density=escape_density))
+        self.stream = b''.join(SlipPacket.encode(f) for f in self.frames)
+        self.chunks = [self.stream[i:i+CHUNK_SIZE]
+                       for i in range(0, len(self.stream), CHUNK_SIZE)]
+        self.packets = [UartPacket(bytearray(f), timestamp=i)
+                        for i, f in enumerate(self.frames)]
+
+
+# Stages.  Each takes a Workload and returns (bytes processed, packets).
+def stage_slip_find(w):
+    buf = bytearray()
+    count = 0
+    for chunk in w.chunks:
+        buf.extend(chunk)
+        count += len(SlipPacket.find(buf))
+    return len(w.stream), count
+
+def stage_slip_decoder(w):
+    decoder = SlipDecoder()
+    count = 0
+    for chunk in w.chunks:
+        count += len(decoder.feed(chunk))
+    return len(w.stream), count
+
+def stage_uart_packet(w):
+    frames = [bytearray(f) for f in w.frames]
+    for frame in frames:
+        UartPacket(frame)
+    return sum(len(f) for f in frames), len(frames)
+
+def stage_sniffer_fields(w):
+    for pkt in w.packets:
+        sp = pkt.sniffer_packet
+        sp.channel, sp.rssi, sp.ec, sp.tdiff, sp.flags
+    return sum(len(f) for f in w.frames), len(w.packets)
+
+def stage_epb(w):
+    out = bytearray()
+    for pkt in w.packets:
+        out.extend(create_epb(pkt).as_bytearray)
+    return len(out), len(w.packets)
+
+def stage_epb_batch(w):
+    out = encode_epbs(w.packets)
+    return len(out), len(w.packets)
+
+def stage_section(w):
+    section = Section(LINKTYPE_BLUETOOTH_LE_LL)
+    for pkt in w.packets:
+        section.add_packet(create_epb(pkt))
+    out = section.as_bytearray
+    return len(out), len(w.packets)
+
+def stage_end_to_end(w):
+    out = io.BytesIO()
+    writer = PcapngStreamWriter(out, Section(LINKTYPE_BLUETOOTH_LE_LL))
+    pbuf = PacketBuffer(high_water=len(w.frames) + 1)
+    pbuf.subscribe(writer)
+    for chunk in w.chunks:
+        pbuf.add(chunk)
+        for _ in pbuf:
+            pass
+    writer.close()
+    return len(w.stream), writer.packets_written
+
+STAGES = [
+    ('slip_find', stage_slip_find),
+    ('slip_decoder', stage_slip_decoder),
+    ('uart_packet', stage_uart_packet),
+    ('sniffer_fields', stage_sniffer_fields),
+    ('epb', stage_epb),
+    ('epb_batch', stage_epb_batch),
+    ('section', stage_section),
+    ('end_to_end', stage_end_to_end),
+]
+
+
+def run_stage(func, workload, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        nbytes, npkts = func(workload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func(workload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'seconds': best,
+        'bytes': nbytes,
+        'packets': npkts,
+        'mb_per_s': nbytes / best / 1e6,
+        'pkts_per_s': npkts / best,
+        'peak_bytes': peak,
+    }
+
+def run(count, repeat, stages, profiles):
+    results = {}
+    for name, sizes, density in PROFILES:
+        if profiles and name not in profiles:
+            continue
+        workload = Workload(name, sizes, density, count)
+        for stage, func in STAGES:
+            if stages and stage not in stages:
+                continue
+            result = run_stage(func, workload, repeat)
+            results['{}/{}'.format(stage, name)] = result
+            print("{:28s} {:9.2f} MB/s {:12,.0f} pkts/s {:10,d} KiB peak".format(
+                  '{}/{}'.format(stage, name), result['mb_per_s'],
+                  result['pkts_per_s'], result['peak_bytes'] // 1024))
+    return results
+
+def compare(results, baseline, tolerance):
+    """Prints every benchmark that lost more than tolerance of its
+    baseline throughput; returns how many did."""
+    regressions = 0
+    for key, base in sorted(baseline['results'].items()):
+        cur = results.get(key)
+        if cur is None:
+            continue
+        ratio = cur['pkts_per_s'] / base['pkts_per_s']
+        if ratio < 1 - tolerance:
+            regressions += 1
+            print("REGRESSION {:28s} {:6.1%} of baseline".format(key, ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=20000,
+                        help="packets per workload")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="timing runs per stage (best is kept)")
+    parser.add_argument('--stage', action='append', default=[],
+                        help="only run this stage (repeatable)")
+    parser.add_argument('--profile', action='append', default=[],
+                        help="only run this workload profile (repeatable)")
+    parser.add_argument('--save', metavar='JSON', help="write results as a baseline")
+    parser.add_argument('--compare', metavar='JSON', help="compare against a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed throughput loss vs baseline (default 0.2)")
+    args = parser.parse_args(argv)
+
+    results = run(args.count, args.repeat, args.stage, args.profile)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'count': args.count, 'python': sys.version.split()[0],
+                       'results': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,16 @@
 #!/usr/bin/env python3
 
 # Sets up the data link to the nRF52 sniffer device.
-import io
-from twisted.internet import reactor
-from twisted.internet.serialport import SerialPort
-from twisted.protocols import basic
-
-from enum import IntEnum
-
+#
+# Only the standard library is imported up front; Twisted, the decode
+# path and (for the TUI) urwid are pulled in by whichever command runs,
+# so a headless capture starts quickly and stays small:
+#
+#   sharktoothle.py capture --port /dev/ttyUSB0 -w out.pcapng --duration 3600
+#   sharktoothle.py tui --port /dev/ttyUSB0
+import argparse
+import os
 import sys
-from twisted.logger import globalLogBeginner, Logger
-from twisted.logger import jsonFileLogObserver, textFileLogObserver
-from twisted.logger import Logger
-from zope.interface import provider
-
-from NordicSniffer.sniffer import *
-from NordicSniffer.packets import *
-from NordicSniffer.pcapng import *
-
-from sharktoothle.ui import SharktoothLE_TUI
-
-
-import urwid
-from urwid import Columns, Filler, Pile, BoxAdapter, LineBox, AttrWrap, Text, Padding
 
 # TODO - packet classes should do nothing with the hardware.
 # Move packet buffer to upper level class.
@@ -40,25 +28,21 @@ from urwid import Columns, Filler, Pile, BoxAdapter, LineBox, AttrWrap, Text, Pa
 #  decode gatt and save examples
 #  allow dummy data to light up the dials
 #
-log = Logger(namespace="main")
 
 class SharkToothLE():
-    palette = [
-        ('header', 'white', 'light blue', 'standout'),
-        ('body', 'light green', 'dark gray'),
-        ('packet_header', 'light cyan', 'dark blue'),
-        ('packet', 'white', 'dark cyan')
-    ]
-
     def __init__(self, port='/dev/ttyUSB0'):
+        from twisted.logger import globalLogBeginner, textFileLogObserver
+        from NordicSniffer import metrics
+        from NordicSniffer.sniffer import NordicSniffer
+        from sharktoothle.ui import SharktoothLE_TUI
         #globalLogBeginner.beginLoggingTo([jsonFileLogObserver(sys.stdout)])
         globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stdout)])
         self._sniffer = NordicSniffer(port=port)
         # self.setup_sniffer()
+        self._metrics = metrics.MetricsRegistry()
+        metrics.track_sniffer(self._metrics, self._sniffer)
 
-        ui = SharktoothLE_TUI()
-        ui.setup_screen()
-        self._ui = ui
+        self._ui = SharktoothLE_TUI(self._sniffer, metrics=self._metrics)
 
     # def setup_sniffer(self):
     #     p = Section(linktype=LINKTYPE_BLUETOOTH_LE_LL)
@@ -80,14 +64,7 @@ class SharkToothLE():
         scr.refresh()
 
     def run(self):
-        self.loop.set_alarm_in(1/60, self.update_screen)
-        self.loop.run()
-
-    def unhandled_input(self, key):
-        if key in ('q', 'Q'):
-            raise urwid.ExitMainLoop()
-    #    print("Key: {}".format(key))
-        return True
+        self._ui.run()
 
     @property
     def port(self):
@@ -99,6 +76,194 @@ class SharkToothLE():
         self._port = port_path
 
 
-if __name__ == "__main__":
-    st = SharkToothLE('/dev/ttyUSB0')
+
+def capture(args):
+    """Headless capture straight to a pcapng file (and/or a Wireshark
+    pipe); no UI code gets imported."""
+    from twisted.internet import reactor
+    from twisted.logger import Logger, globalLogBeginner, textFileLogObserver
+    from NordicSniffer.PacketBuffer import PacketBuffer
+    from NordicSniffer.pcapng import (LINKTYPE_BLUETOOTH_LE_LL, Option, OptionCode,
+                                      PcapngStreamWriter, Section,
+                                      SHB_OPTION_HARDWARE, SHB_OPTION_USERAPPL)
+    from NordicSniffer.sniffer import SNIFFER_BAUD_RATES, NordicSniffer
+
+    globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stderr)])
+    log = Logger(namespace="capture")
+
+    ports = args.port or ['/dev/ttyUSB0']
+    packet_filter = None
+    if args.filter:
+        from NordicSniffer.filter import FilterError, PacketFilter
+        try:
+            packet_filter = PacketFilter(args.filter)
+        except FilterError as e:
+            sys.exit("bad --filter: {}".format(e))
+    closers = []
+    baud_kwargs = {'baud': args.baud,
+                   'baud_rates': None if args.fixed_baud else SNIFFER_BAUD_RATES}
+    if len(ports) > 1:
+        if args.pipe or args.split or args.ring_buffer:
+            sys.exit("--pipe, --split and --ring-buffer only work with a single --port")
+        from NordicSniffer.multi import MultiSnifferCapture
+        multi = MultiSnifferCapture(ports, args.write, **baud_kwargs)
+        if packet_filter is not None:
+            # One each, so each sniffer's counts are its own
+            for sniffer in multi.sniffers:
+                sniffer.pbuf.packet_filter = args.filter
+        closers.append(multi.close)
+        writer = multi.writer
+        sniffers = multi.sniffers
+        pipe = None
+    else:
+        section = Section(LINKTYPE_BLUETOOTH_LE_LL)
+        section.shb.options.add([
+            Option(SHB_OPTION_HARDWARE, "Nordic NRF52 Bluetooth LE Sniffer"),
+            Option(SHB_OPTION_USERAPPL, "SharkToothLE")
+            ])
+        section.idb.options.add([
+            Option(OptionCode.IF_NAME, os.path.basename(ports[0])),
+            Option(OptionCode.IF_DESCRIPTION, "Nordic BLE Sniffer Firmware")
+            ])
+        sniffer = NordicSniffer(port=ports[0],
+                                pbuf=PacketBuffer(high_water=0, packet_filter=packet_filter),
+                                **baud_kwargs)
+        sniffers = [sniffer]
+        writer = pipe = None
+        if args.write and args.ring_buffer:
+            from NordicSniffer.rotate import RotatingPcapngWriter
+            writer = RotatingPcapngWriter(args.write, section, **args.ring_buffer)
+            sniffer.add_sink(writer)
+            closers.append(writer.close)
+        elif args.write:
+            writer = PcapngStreamWriter(args.write, section)
+            sniffer.add_sink(writer)
+            closers.append(writer.close)
+        if args.pipe:
+            from NordicSniffer.pipe import PcapngPipeSink
+            pipe = PcapngPipeSink(args.pipe, section)
+            pipe.start()
+            sniffer.add_sink(pipe)
+            closers.append(pipe.stop)
+        if args.split:
+            from NordicSniffer.demux import ConnectionDemux
+            demux = ConnectionDemux(args.split, section, max_open=args.split_max_open)
+            sniffer.add_sink(demux)
+            closers.append(demux.close)
+
+    if writer is not None and args.stats_interval:
+        from NordicSniffer.loss import LossReporter
+        for iface_id, sniffer in enumerate(sniffers):
+            reporter = LossReporter(writer, sniffer.pbuf, iface_id=iface_id,
+                                    interval=args.stats_interval).start()
+            closers.insert(0, reporter.stop)
+
+    if args.metrics:
+        from NordicSniffer import metrics
+        registry = metrics.MetricsRegistry()
+        for sniffer in sniffers:
+            metrics.track_sniffer(registry, sniffer)
+        if writer is not None:
+            metrics.track_writer(registry, writer, consumer='file')
+        if pipe is not None:
+            metrics.track_pipe(registry, pipe)
+        closers.append(metrics.PrometheusFile(registry, args.metrics,
+                                              interval=args.metrics_interval).start().stop)
+
+    if args.duration:
+        reactor.callLater(args.duration, reactor.stop)
+    log.info("capturing from {ports}", ports=", ".join(ports))
+    try:
+        reactor.run()
+    finally:
+        for close in closers:
+            close()
+    if writer is not None and args.ring_buffer:
+        log.info("{count} packets written to {files} files, the last {path}",
+                 count=writer.packets_written, files=writer.file_count, path=writer.path)
+    elif writer is not None:
+        log.info("{count} packets written to {path}",
+                 count=writer.packets_written, path=args.write)
+    return 0
+
+# dumpcap's -b keys, and what they set on a RotatingPcapngWriter
+RING_BUFFER_KEYS = {
+    'filesize': ('max_size', lambda kb: int(kb) * 1000),
+    'duration': ('max_duration', float),
+    'files': ('max_files', int),
+}
+
+def ring_buffer_options(specs):
+    """RotatingPcapngWriter keyword arguments for -b key:value specs"""
+    options = {}
+    for spec in specs:
+        key, _, value = spec.partition(':')
+        if key not in RING_BUFFER_KEYS:
+            raise ValueError("unknown ring buffer option '{}'".format(key))
+        name, convert = RING_BUFFER_KEYS[key]
+        try:
+            options[name] = convert(value)
+        except ValueError:
+            raise ValueError("bad value for {}: '{}'".format(key, value)) from None
+        if options[name] <= 0:
+            raise ValueError("{} must be positive".format(key))
+    return options
+
+def tui(args):
+    st = SharkToothLE((args.port or ['/dev/ttyUSB0'])[0])
     st.run()
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Nordic nRF52 BLE sniffer front end")
+    commands = parser.add_subparsers(dest='command')
+
+    cap = commands.add_parser('capture', help="capture to pcapng without the UI")
+    cap.add_argument('--port', action='append',
+                     help="sniffer serial port (repeat for several sniffers)")
+    cap.add_argument('-w', '--write', metavar='PCAPNG', help="capture file to write")
+    cap.add_argument('--duration', type=float, help="stop after this many seconds")
+    cap.add_argument('--baud', type=int, default=460800,
+                     help="serial baud rate to connect at (default 460800)")
+    cap.add_argument('--fixed-baud', action='store_true',
+                     help="stay at --baud rather than negotiating a faster rate")
+    cap.add_argument('--pipe', metavar='FIFO', help="also stream to Wireshark via this FIFO")
+    cap.add_argument('--filter', metavar='EXPR',
+                     help="only keep packets matching EXPR, e.g. "
+                          "'channel in (37,38) and rssi > -70 and not crc_error'")
+    cap.add_argument('--split', metavar='DIR',
+                     help="also write a pcapng per connection (and one of advertising) into DIR")
+    cap.add_argument('--split-max-open', type=int, default=64,
+                     help="connection files kept open at once by --split (default 64)")
+    cap.add_argument('-b', '--ring-buffer', metavar='KEY:VALUE', action='append',
+                     help="write -w as a ring of files, like dumpcap: filesize:KB, "
+                          "duration:SECONDS and/or files:N (repeat for several)")
+    cap.add_argument('--stats-interval', type=float, default=10.0,
+                     help="seconds between loss statistics blocks in the capture (0 for none)")
+    cap.add_argument('--metrics', metavar='PROM',
+                     help="write pipeline metrics to this file in Prometheus text format")
+    cap.add_argument('--metrics-interval', type=float, default=10.0,
+                     help="seconds between metrics writes (default 10)")
+    cap.set_defaults(func=capture)
+
+    ui = commands.add_parser('tui', help="interactive terminal UI (the default)")
+    ui.add_argument('--port', action='append', help="sniffer serial port")
+    ui.set_defaults(func=tui)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(['tui'] + (argv if argv is not None else sys.argv[1:]))
+    if args.command == 'capture':
+        if not (args.write or args.pipe or args.split):
+            parser.error("capture needs -w, --pipe and/or --split")
+        if args.ring_buffer:
+            if not args.write:
+                parser.error("--ring-buffer needs -w")
+            try:
+                args.ring_buffer = ring_buffer_options(args.ring_buffer)
+            except ValueError as e:
+                parser.error(str(e))
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,29 @@
+from itertools import islice
 from twisted.logger import Logger
-from urwid import AttrWrap, BoxAdapter, Columns, Filler, LineBox, MainLoop, Text, TwistedEventLoop
-from sharktoothle.widgets import PacketView, UartPacketRow
+from urwid import (AttrWrap, BoxAdapter, Columns, ExitMainLoop, Filler, LineBox, MainLoop,
+                   Padding, Pile, Text, TwistedEventLoop)
+from sharktoothle.widgets import ButtonPanel, MetricsPanel, PacketView, UartPacketRow
 
 log = Logger(namespace="UI")
 
 # User Interface
 class SharktoothLE_TUI:
-    def __init__(self, event_loop=TwistedEventLoop()):
-        self._evl = event_loop
+    # Shows the packets queued in sniffer's PacketBuffer; each refresh
+    # takes at most batch_size of them off it, so a burst costs several
+    # frames rather than one long one.  Writing them anywhere is up to
+    # the sniffer's sinks.
+    palette = [
+        ('header', 'white', 'light blue', 'standout'),
+        ('body', 'light green', 'dark gray'),
+        ('packet_header', 'light cyan', 'dark blue'),
+        ('packet', 'white', 'dark cyan')
+    ]
+
+    def __init__(self, sniffer, event_loop=None, metrics=None, batch_size=4096):
+        self._sniffer = sniffer
+        self._evl = TwistedEventLoop() if event_loop is None else event_loop
+        self._metrics = metrics
+        self.batch_size = batch_size
         self.setup_screen()
 
     def setup_screen(self):
@@ -18,21 +34,31 @@ class SharktoothLE_TUI:
         pktlist = BoxAdapter(AttrWrap(self.pktlist, 'packet'), 20)
         pktlist = Padding(LineBox(pktlist, title="UART Packets"), align='center', left=2, right=2)
         buttons = Padding(ButtonPanel(), align='center', left=2)
-        pile = Pile([header, Columns([(16, BoxAdapter(Filler(buttons, valign='middle'),20)), pktlist])])
+        rows = [header, Columns([(18, BoxAdapter(Filler(buttons, valign='middle'),20)), pktlist])]
+        self.metrics_panel = None
+        if self._metrics is not None:
+            self.metrics_panel = MetricsPanel(self._metrics)
+            rows.append(Padding(LineBox(self.metrics_panel, title="Pipeline"),
+                                align='center', left=2, right=2))
+        pile = Pile(rows)
         top = Filler(pile, valign='top')
 
-        self.evl = TwistedEventLoop()
         self.loop = MainLoop(top, self.palette,
-                      unhandled_input=self.unhandled_input, event_loop=self.evl)
+                      unhandled_input=self.unhandled_input, event_loop=self._evl)
 
-    def update_screen(self, data):
-        pl = self.pktlist
+    def run(self):
+        """Runs the UI (and with it the reactor) until q is pressed."""
+        self.loop.set_alarm_in(1/60, self.update_screen)
+        self.loop.run()
 
-        for pkt in self._sniffer.pbuf:
-            pl.append(pkt)
-            self.cnt = self.cnt + 1
-            self._pktsec.add_packet(EnhancedPacketBlock(pkt.data))
+    def unhandled_input(self, key):
+        if key in ('q', 'Q'):
+            raise ExitMainLoop()
+        return True
 
-    #    with open('test.pcapng', 'wb') as f:
-    #        f.write(self._pktsec.as_bytearray)
+    def update_screen(self, loop=None, data=None):
+        pkts = list(islice(self._sniffer.pbuf, self.batch_size))
+        self.pktlist.extend(pkts)
+        if self.metrics_panel is not None:
+            self.metrics_panel.update()
         self.loop.set_alarm_in(1/30, self.update_screen)
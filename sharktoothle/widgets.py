@@ -1,31 +1,157 @@
-from urwid import (AttrWrap, BoxAdapter, Button, Columns, Frame, GridFlow, LineBox,
-                   ListBox, Pile, SimpleFocusListWalker, Text)
+import time
+from collections import OrderedDict, deque
+from urwid import (AttrWrap, Button, Columns, Frame, GridFlow, LineBox,
+                   ListBox, ListWalker, Pile, Text)
 from NordicSniffer.packets import UartPacket
 
-class PacketView(BoxAdapter):
+class PacketView(Frame):
     # Frame has a Columns header and a listbox.
     # Maybe total packet count as the footer?
-    def __init__(self, cls):
-        self.header = cls.header
-        self.plb = PacketListBox()
+    def __init__(self, cls, pool_size=128):
+        self.plb = PacketListBox(row_cls=cls, pool_size=pool_size)
+        header = cls.header()
 
-        super().__init__(self.plb, AttrWrap(self.header, 'packet_header'))
+        super().__init__(self.plb, None if header is None else AttrWrap(header, 'packet_header'))
 
     def append(self, pkt):
         self.plb.append(pkt)
 
+    def extend(self, pkts):
+        self.plb.extend(pkts)
+
+
+class PacketRingWalker(ListWalker):
+    """ListWalker over the last capacity packets.
+
+    Only the packets are stored; row widgets are made when the ListBox
+    asks for a position, i.e. for what's on screen when it redraws, and
+    come from a pool of pool_size rows that get refilled with whichever
+    packet they're needed for next.  So keeping up with the sniffer
+    costs a deque append per packet whatever the packet rate.  A row
+    handed out since the last begin_render() is never refilled, so a
+    screen taller than the pool grows it rather than drawing a row
+    twice.
+
+    Positions are packet sequence numbers (0 for the first packet ever
+    appended) so they stay put as old packets fall off the ring.  While
+    the newest packet has the focus, the focus follows new packets."""
+
+    def __init__(self, row_cls, capacity=10000, pool_size=128, attr='packet'):
+        self._row_cls = row_cls
+        self._ring = deque(maxlen=capacity)
+        self._total = 0
+        self._pool = OrderedDict()
+        self._pool_size = pool_size
+        self._in_use = set()
+        self._attr = attr
+        self.focus = None
+
+    def __len__(self):
+        return len(self._ring)
+
+    @property
+    def first(self):
+        """position of the oldest packet still held"""
+        return self._total - len(self._ring)
+
+    @property
+    def last(self):
+        return self._total - 1
+
+    @property
+    def following(self):
+        return self.focus is None or self.focus == self.last
+
+    def append(self, pkt):
+        self.extend((pkt,))
+
+    def extend(self, pkts):
+        if not isinstance(pkts, (list, tuple)):
+            pkts = list(pkts)
+        if not pkts:
+            return
+        following = self.following
+        self._ring.extend(pkts)
+        self._total += len(pkts)
+        if following:
+            self.focus = self.last
+        elif self.focus < self.first:
+            self.focus = self.first
+        self._modified()
+
+    def __getitem__(self, position):
+        if not isinstance(position, int) or not self.first <= position <= self.last:
+            raise IndexError(position)
+        pool = self._pool
+        self._in_use.add(position)
+        widget = pool.get(position)
+        if widget is not None:
+            pool.move_to_end(position)
+            return widget
+        pkt = self._ring[position - self.first]
+        widget = self._recycle() if len(pool) >= self._pool_size else None
+        if widget is not None:
+            widget.original_widget.update(pkt)
+        else:
+            widget = AttrWrap(self._row_cls(pkt), self._attr)
+        pool[position] = widget
+        return widget
+
+    def _recycle(self):
+        """Takes the least recently used row that isn't on screen out of
+        the pool, or returns None if they all are"""
+        in_use = self._in_use
+        for position in self._pool:
+            if position not in in_use:
+                return self._pool.pop(position)
+        return None
+
+    def begin_render(self):
+        """Called before each render; rows handed out before this are
+        free to be refilled again"""
+        self._in_use.clear()
+        pool = self._pool
+        while len(pool) > self._pool_size:
+            pool.popitem(last=False)
+
+    def next_position(self, position):
+        if position >= self.last:
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= self.first:
+            raise IndexError(position)
+        return position - 1
+
+    def set_focus(self, position):
+        if not self.first <= position <= self.last:
+            raise IndexError(position)
+        self.focus = position
+        self._modified()
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(self.last, self.first - 1, -1)
+        return range(self.first, self._total)
+
 
 class PacketListBox(ListBox):
-    def __init__(self, max_buffer=50):
+    def __init__(self, max_buffer=10000, row_cls=None, pool_size=128):
         self.max_buffer = max_buffer
-        body = SimpleFocusListWalker([])
+        body = PacketRingWalker(UartPacketRow if row_cls is None else row_cls,
+                                capacity=max_buffer, pool_size=pool_size)
         super().__init__(body)
 
+    def render(self, size, focus=False):
+        self.body.begin_render()
+        return super().render(size, focus)
+
     def append(self, pkt):
-        overage = len(self.body) - self.max_buffer
-        del self.body[0:overage]
-        row = AttrWrap(UartPacketRow(pkt), 'packet')
-        self.body.append(row)
+        self.body.append(pkt)
+
+    def extend(self, pkts):
+        self.body.extend(pkts)
 
 
 class PacketRow(Columns):
@@ -34,35 +160,39 @@ class PacketRow(Columns):
         super().__init__(cols, dividechars)
         pass
 
-    @property
-    def header(self):
+    @classmethod
+    def header(cls):
+        """column headings for rows of this class, or None"""
         return None
 
 class UartPacketRow(PacketRow):
     _divchars = 0
 
-    @property
-    def header(self):
+    @classmethod
+    def header(cls):
         cols = [
             (24, Text(u"Timestamp")),
             (16, Text(u"Packet #")),
             (16, Text(u"Packet ID")),
             (16, Text(u"Payload Length"))
         ]
-        return Columns(cols, dividechars=self._divchars)
+        return Columns(cols, dividechars=cls._divchars)
 
     def __init__(self, pkt):
+        self._texts = [Text(u"") for _ in range(4)]
+        cols = [(width, text) for width, text in zip((24, 16, 16, 16), self._texts)]
+        super().__init__(cols, dividechars=0)
+        self.update(pkt)
+
+    def update(self, pkt):
+        """Shows pkt in this row (rows get reused by PacketRingWalker)"""
         if not isinstance(pkt, UartPacket):
             raise ValueError(u"{} doesn't derive from UartPacket!".format(type(pkt)))
-
-        cols = [
-            (24, Text(u"{:d}".format(pkt.timestamp))),
-            (16, Text(u"{:d}".format(pkt.pc))),
-            (16, Text(u"{:s}".format(pkt.id.name))),
-            (16, Text(u"{:d} bytes".format(pkt.plen)))
-        ]
-
-        super().__init__(cols, dividechars=0)
+        ts, pc, pkt_id, plen = self._texts
+        ts.set_text(u"{:d}".format(pkt.timestamp))
+        pc.set_text(u"{:d}".format(pkt.pc))
+        pkt_id.set_text(u"{:s}".format(pkt.id.name))
+        plen.set_text(u"{:d} bytes".format(pkt.plen))
 
 
     # Render like:
@@ -71,6 +201,41 @@ class UartPacketRow(PacketRow):
     # different payload represnetations can have more columns...
 
 
+class MetricsPanel(Text):
+    """Shows a MetricsRegistry's series, with per-second rates for the
+    counters; refreshed at most every interval seconds."""
+
+    def __init__(self, registry, interval=1.0):
+        self._registry = registry
+        self._interval = interval
+        self._last = None
+        self._last_time = None
+        super().__init__(u"")
+
+    def update(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self._last_time is not None and now - self._last_time < self._interval:
+            return
+        prefix = self._registry.prefix + '_' if self._registry.prefix else ''
+        lines = []
+        current = {}
+        for metric in self._registry:
+            for labels, value in metric.samples():
+                series = (metric.name, tuple(sorted(labels.items())))
+                current[series] = value
+                name = metric.name[len(prefix):] if metric.name.startswith(prefix) else metric.name
+                if labels:
+                    name += u" " + u" ".join(u"{}".format(v) for _, v in sorted(labels.items()))
+                line = u"{:40s} {:>12}".format(name, value)
+                if metric.kind == 'counter' and self._last is not None:
+                    prev = self._last.get(series, 0)
+                    line += u" {:>10.1f}/s".format((value - prev) / (now - self._last_time))
+                lines.append(line)
+        self._last = current
+        self._last_time = now
+        self.set_text(u"\n".join(lines))
+
+
 class ButtonPanel(GridFlow):
     def __init__(self):
         buttons = [